@@ -1,56 +1,892 @@
-import collections, dataclasses, functools
+import array, asyncio, bisect, collections, collections.abc, concurrent.futures, contextlib, dataclasses, functools, heapq, itertools, operator, os, threading, types, weakref
 from typing import Any
 from dlog_common import *
 
-_action_queue = collections.deque()
+class Scheduler:
+    '''
+    Delta propagation for one dataflow graph. Operators belong to the
+    scheduler of their inputs; base relations take it as `scheduler=` and
+    use default_scheduler otherwise. Relations of different graphs can't be
+    combined.
+
+    Pending flushes run in rank order. Ranks number the strongly connected
+    components of the graph topologically, so each component (a single
+    operator or a whole recursive cycle) sees all changes of its inputs at
+    once and runs to fixpoint before anything downstream of it runs.
+    '''
+
+    def __init__(self):
+        self._nodes = weakref.WeakSet()
+        # (rank, arrival, relation) for relations waiting to flush
+        self._pending = []
+        self._arrivals = itertools.count()
+        self._actions = collections.deque()
+        # relations holding over-deleted tuples, see SimpleRelation._over_delete
+        self._rederive_queue = []
+        # while set, relations deliver only removals and park their additions here
+        self._deleting = False
+        self._deferred = []
+
+        # see transaction() and snapshot()
+        self.version = 0
+        self._commit_lock = threading.Lock()
+        self._snapshot_lock = _ReadWriteLock()
+        self._undo_lock = threading.Lock()
+        self._committing = False
+        self._touched = []
+        # exception of a commit that failed half-way, see _commit
+        self._failed = None
+
+        # called after every sync(), e.g. to write out a batch of a log
+        self._sync_hooks = []
+
+    def _add(self, rel):
+        self._nodes.add(rel)
+        rel._rank = max(( r._rank for r in rel._inputs() ), default=-1) + 1
+
+    def run_later(self, f, *args):
+        # actions not tied to an operator run before any pending flush
+        self._actions.append(functools.partial(f, *args))
+
+    def _schedule(self, rel):
+        heapq.heappush(self._pending, (rel._rank, next(self._arrivals), rel))
+
+    def _run_queue(self):
+        while self._actions or self._pending:
+            if self._actions:
+                self._actions.popleft()()
+            else:
+                heapq.heappop(self._pending)[2]._flush()
+
+    def sync(self):
+        # Delete-and-Rederive: removals propagate to a fixpoint first, then the
+        # over-deleted tuples that still have a derivation are put back, and
+        # only then the additions are let through. Letting additions race the
+        # removals around a cycle can keep a self-supporting tuple alive forever.
+        while self._actions or self._pending or self._rederive_queue:
+            self._propagate_removals()
+            self._propagate_additions()
+
+        for hook in list(self._sync_hooks):
+            hook()
+
+    def _propagate_removals(self):
+        self._deleting = True
+        try:
+            self._run_queue()
+        finally:
+            self._deleting = False
+
+    def _propagate_additions(self):
+        rels = list(self._rederive_queue)
+        self._rederive_queue.clear()
+        for r in rels:
+            r._rederive_pending()
+
+        rels = list(self._deferred)
+        self._deferred.clear()
+        for r in rels:
+            r._schedule_flush()
+
+        self._run_queue()
+
+    def transaction(self):
+        '''Starts staging changes to DataRelations of this graph, see Transaction.'''
+        return Transaction(self)
+
+    def snapshot(self):
+        '''Consistent read-only view of the last committed version, see Snapshot.'''
+        return Snapshot(self)
+
+    def _commit(self, changes):
+        with self._commit_lock:
+            if self._failed is not None:
+                raise RuntimeError('a previous commit failed, the graph is no longer updated') from self._failed
+
+            self._committing = True
+            try:
+                for rel, (added, removed) in changes.items():
+                    rel.update(added=added, removed=removed)
+                self.sync()
+            except BaseException as exc:
+                # The changes are partly propagated and operator state (e.g.
+                # counts) can't be rolled back. Nothing is published:
+                # snapshots keep rebuilding the last version from the undo
+                # deltas, and later commits are refused.
+                self._failed = exc
+                raise
+
+            # publish: wait for readers of the previous version to finish
+            with self._snapshot_lock.writing():
+                for rel in self._touched:
+                    rel._undo = None
+                self._touched = []
+                self._committing = False
+                self.version += 1
+            return self.version
+
+    def _record_undo(self, rel, added, removed):
+        # called with _undo_lock held, just before `rel` changes: keeps the
+        # tuples added and removed since the last published version, from
+        # which snapshots rebuild it
+        if rel._undo is None:
+            rel._undo = (set(), set())
+            self._touched.append(rel)
+        undo_added, undo_removed = rel._undo
+        for x in removed:
+            if x in undo_added:
+                undo_added.remove(x)
+            else:
+                undo_removed.add(x)
+        for x in added:
+            if x in undo_removed:
+                undo_removed.remove(x)
+            else:
+                undo_added.add(x)
+
+    def _raise_rank(self, rel, rank):
+        # keeps ranks topological after `rel` got an input of rank `rank - 1`
+        stack = [(rel, rank)]
+        while stack:
+            node, rank = stack.pop()
+            if node._rank >= rank:
+                continue
+            if node._recursive:
+                self._rerank()
+                return
+            node._rank = rank
+            stack.extend( (d, rank + 1) for d in node._downstream() )
+
+    def _rerank(self):
+        # Tarjan's algorithm along input edges - a component is finished only
+        # after every component it reads from, which gives the rank order
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        rank = 0
+
+        def visit(node):
+            index[node] = low[node] = len(index)
+            stack.append(node)
+            on_stack.add(node)
+            work.append((node, iter(node._inputs())))
+
+        for root in list(self._nodes):
+            if root in index:
+                continue
+            work = []
+            visit(root)
+            while work:
+                node, inputs = work[-1]
+                for i in inputs:
+                    if i not in index:
+                        visit(i)
+                        break
+                    elif i in on_stack:
+                        low[node] = min(low[node], index[i])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            member._rank = rank
+                            if member is node:
+                                break
+                        rank += 1
+
+class _ReadWriteLock:
+    # many readers or one writer; waiting writers block new readers
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+class Transaction:
+    '''
+    Adds and removals of DataRelation tuples staged by one writer. Writers
+    in different threads each use their own transaction; commit() applies
+    the changes atomically and propagates them (commits are serialized) and
+    returns the new version. Used as a context manager, it commits unless
+    an exception is raised.
+
+    If propagation raises (e.g. in an external function), the exception is
+    passed on and the graph stays at the last version: snapshots still
+    read it, and every later commit raises RuntimeError.
+    '''
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        # relation -> (added, removed)
+        self._changes = {}
+
+    def __staged(self, rel):
+        _check_same_graph(self._scheduler, [rel])
+        if rel not in self._changes:
+            self._changes[rel] = (set(), set())
+        return self._changes[rel]
+
+    def add(self, rel, t):
+        added, removed = self.__staged(rel)
+        removed.discard(t)
+        added.add(t)
+
+    def remove(self, rel, t):
+        added, removed = self.__staged(rel)
+        added.discard(t)
+        removed.add(t)
+
+    def commit(self):
+        changes = self._changes
+        self._changes = {}
+        return self._scheduler._commit(changes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.commit()
+
+class Snapshot:
+    '''
+    Read-only view of a graph at one committed version, valid until closed
+    (or the end of the with block). A commit propagating meanwhile is not
+    visible; publishing the next version waits until the snapshot is closed.
+    '''
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        scheduler._snapshot_lock.acquire_read()
+        self.version = scheduler.version
+        self._closed = False
+
+    def to_set(self, rel):
+        _check_same_graph(self._scheduler, [rel])
+        with self._scheduler._undo_lock:
+            tuples = set(rel._tuples)
+            if rel._undo is None:
+                return tuples
+            added, removed = rel._undo
+            return (tuples - added) | removed
+
+    def iter(self, rel):
+        yield from sorted(self.to_set(rel))
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._scheduler._snapshot_lock.release_read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+default_scheduler = Scheduler()
 
 def run_later(f, *args):
-    _action_queue.append(functools.partial(f, *args))
+    default_scheduler.run_later(f, *args)
 
 def sync():
-    while _action_queue:
-        f = _action_queue.popleft()
-        f()
+    default_scheduler.sync()
+
+class SortedTupleStore:
+    '''
+    Ordered storage for the tuples of a relation: a sorted list plus a buffer
+    of pending additions and removals, merged in on the next read.
+    '''
+
+    _SMALL_MERGE = 8
+
+    def __init__(self, tuples=()):
+        self._sorted = sorted(tuples)
+        self._added = set()
+        self._removed = set()
+
+    def add(self, t):
+        if t in self._removed:
+            self._removed.remove(t)
+        else:
+            self._added.add(t)
+
+    def discard(self, t):
+        if t in self._added:
+            self._added.remove(t)
+        else:
+            self._removed.add(t)
+
+    def __len__(self):
+        return len(self._sorted) + len(self._added) - len(self._removed)
+
+    def _merge(self):
+        if self._removed:
+            if len(self._removed) <= self._SMALL_MERGE:
+                for t in self._removed:
+                    del self._sorted[bisect.bisect_left(self._sorted, t)]
+            else:
+                self._sorted = [ t for t in self._sorted if t not in self._removed ]
+            self._removed = set()
+
+        if self._added:
+            if len(self._added) <= self._SMALL_MERGE:
+                for t in self._added:
+                    bisect.insort(self._sorted, t)
+            else:
+                # timsort merges the two sorted runs in linear time
+                self._sorted += sorted(self._added)
+                self._sorted.sort()
+            self._added = set()
+
+    def irange(self, lo=None, hi=None):
+        self._merge()
+        i = 0 if lo is None else bisect.bisect_left(self._sorted, lo)
+        j = len(self._sorted) if hi is None else bisect.bisect_left(self._sorted, hi)
+        return self._sorted[i:j]
+
+class _Column:
+    # one column of a ColumnarTupleStore: machine integers while all values
+    # fit, dictionary-encoded values (codes into `dictionary`) otherwise
 
-class SimpleRelation:
     def __init__(self):
-        self._add_callbacks = []
-        self._remove_callbacks = []
+        self.data = array.array('q')
+        self.dictionary = None
+        self.codes = None
+
+    def get(self, row):
+        v = self.data[row]
+        return v if self.dictionary is None else self.dictionary[v]
+
+    def encode(self, v):
+        if self.dictionary is None:
+            if type(v) is int and -2**63 <= v < 2**63:
+                return v
+            self.dictionary = []
+            self.codes = {}
+            for i, old in enumerate(self.data):
+                self.data[i] = self.encode(old)
+
+        # keyed by type too, so that e.g. True and 1 keep their identity
+        code = self.codes.get((type(v), v))
+        if code is None:
+            code = self.codes[type(v), v] = len(self.dictionary)
+            self.dictionary.append(v)
+        return code
+
+class ColumnarTupleStore(collections.abc.MutableSet):
+    '''
+    Compact set of fixed-arity tuples, usable as the `storage` of a
+    relation. Values are kept column by column in array buffers (see
+    _Column) and membership goes through an open-addressing hash table of
+    row numbers, so no Python tuple is kept alive per row.
+
+    Rows are decoded back into tuples on every access, which makes this
+    slower than a plain set; it is meant for large relations where memory
+    matters more.
+
+    Only the store itself is compact. Membership tests, iteration,
+    to_set() copies and the deltas sent to subscribers keep it that way.
+    But secondary indexes hold a Python tuple per row. They are built by
+    _get_index(), i.e. iter_with_prefix() and the lookups of every
+    SimpleJoin, SimpleArbitraryJoin or SimpleMultiJoin reading the
+    relation. The ordered store behind iter() and iter_range() does the
+    same. So the savings hold for relations that are only appended to and
+    scanned, or read through projections and unions, not for join inputs.
+    '''
+
+    _EMPTY = 0
+    _DELETED = -1
+
+    def __init__(self, arity, tuples=()):
+        self.arity = arity
+        self._columns = [ _Column() for i in range(arity) ]
+        self._len = 0
+        # slot -> row + 1, or _EMPTY / _DELETED
+        self._table = array.array('i', bytes(4 * 8))
+        self._used_slots = 0
+        for t in tuples:
+            self.add(t)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        # results of set operators are ordinary sets
+        return set(it)
+
+    def __len__(self):
+        return self._len
+
+    def _row(self, r):
+        return tuple( column.get(r) for column in self._columns )
+
+    def __iter__(self):
+        for r in range(self._len):
+            yield self._row(r)
+
+    def _find(self, t):
+        # returns (slot, row); row is None and slot is where t would be
+        # inserted if t is not present
+        mask = len(self._table) - 1
+        i = hash(t) & mask
+        free = None
+        while True:
+            r = self._table[i]
+            if r == self._EMPTY:
+                return (i if free is None else free), None
+            elif r == self._DELETED:
+                if free is None: free = i
+            elif self._row(r - 1) == t:
+                return i, r - 1
+            i = (i + 1) & mask
+
+    def __contains__(self, t):
+        if not isinstance(t, tuple) or len(t) != self.arity:
+            return False
+        return self._find(t)[1] is not None
+
+    def add(self, t):
+        if len(t) != self.arity:
+            raise ValueError('expected a tuple of arity %d, got %r' % (self.arity, t))
+        slot, row = self._find(t)
+        if row is not None:
+            return
+
+        for column, v in zip(self._columns, t):
+            column.data.append(column.encode(v))
+        self._len += 1
+        if self._table[slot] == self._EMPTY:
+            self._used_slots += 1
+        self._table[slot] = self._len
+
+        if self._used_slots * 2 > len(self._table):
+            self._rehash()
+
+    def discard(self, t):
+        if not isinstance(t, tuple) or len(t) != self.arity:
+            return
+        slot, row = self._find(t)
+        if row is None:
+            return
+        self._table[slot] = self._DELETED
+
+        # move the last row into the hole
+        last = self._len - 1
+        if row != last:
+            mask = len(self._table) - 1
+            i = hash(self._row(last)) & mask
+            while self._table[i] != last + 1:
+                i = (i + 1) & mask
+            self._table[i] = row + 1
+            for column in self._columns:
+                column.data[row] = column.data[last]
+
+        for column in self._columns:
+            column.data.pop()
+        self._len -= 1
+
+    def remove(self, t):
+        if t not in self:
+            raise KeyError(t)
+        self.discard(t)
+
+    def _rehash(self):
+        size = 8
+        while size < 2 * self._len:
+            size *= 2
+        self._table = array.array('i', bytes(4 * size))
+        mask = size - 1
+        for r in range(self._len):
+            i = hash(self._row(r)) & mask
+            while self._table[i] != self._EMPTY:
+                i = (i + 1) & mask
+            self._table[i] = r + 1
+        self._used_slots = self._len
+
+# every SimpleRelation not yet garbage collected, see live_operators()
+_live_operators = weakref.WeakSet()
+
+def live_operators():
+    '''Number of operator nodes still alive, to make leaked graphs visible.'''
+    return len(_live_operators)
+
+def _callback_ref(cb):
+    # bound methods are held weakly, so operators nobody uses any more are
+    # garbage collected and drop out of their inputs' callbacks; other
+    # callables stay until unsubscribed
+    if isinstance(cb, types.MethodType):
+        return weakref.WeakMethod(cb)
+    return lambda: cb
+
+def _check_same_graph(scheduler, rels):
+    if any( r._scheduler is not scheduler for r in rels ):
+        raise ValueError('relations of different dataflow graphs can not be combined')
+
+@dataclasses.dataclass
+class RelationStats:
+    count: int
+    # number of distinct values in each column
+    distinct: tuple
 
-        self._tuples = set()
+class SimpleRelation:
+    # factory for the ordered store backing iter()/iter_range(); any class
+    # with the SortedTupleStore interface can be plugged in here
+    ordered_store = SortedTupleStore
+
+    def __init__(self, *, storage=None, scheduler=None):
+        # (callback ref, args) pairs, called as cb(*args, added, removed) with
+        # the net delta of each round
+        self._delta_callbacks = []
+
+        # `storage` is an optional factory taking the arity and returning a
+        # set-like container for the tuples, e.g. ColumnarTupleStore (see
+        # there for which reads keep the storage compact)
+        self._tuples = set() if storage is None else storage(self.arity)
+        self._indexes = {}
+        self._ordered = None
         self._changed = False
 
+        # delta not yet delivered to _delta_callbacks
+        self._added = set()
+        self._removed = set()
+        self._flush_scheduled = False
+
+        # set on operators that lie on a SimpleLink cycle
+        self._recursive = False
+        self._rederive = set()
+
+        # (added, removed) since the last committed version while a commit
+        # changes the tuples, see Scheduler._record_undo
+        self._undo = None
+
+        # key in _shared_nodes if the node was built by _shared, and the
+        # number of times _shared handed it out, see close()
+        self._shared_key = None
+        self._holders = 0
+
         self._debug = False
+        _live_operators.add(self)
+
+        inputs = self._inputs()
+        if scheduler is None:
+            scheduler = inputs[0]._scheduler if inputs else default_scheduler
+        _check_same_graph(scheduler, inputs)
+        self._scheduler = scheduler
+        scheduler._add(self)
+
         self._enable()
 
     def _enable(self):
         pass
 
+    def _inputs(self):
+        return []
+
+    def _downstream(self):
+        # operators subscribed to this one
+        result = []
+        for ref, args in self._delta_callbacks:
+            node = getattr(ref(), '__self__', None)
+            if isinstance(node, SimpleRelation):
+                result.append(node)
+            elif isinstance(node, _KeyRouter):
+                result.extend(node._downstream())
+        return result
+
+    def _subscribe(self, cb, *args):
+        # new subscribers see everything that was already delivered to the
+        # others as one big addition; the pending delta follows on flush
+        self._delta_callbacks.append((_callback_ref(cb), args))
+        cb(*args, self._delivered(), set())
+
+    def _unsubscribe(self, subscriber):
+        # removes one subscription of `subscriber` (an operator or a callback)
+        for i, (ref, args) in enumerate(self._delta_callbacks):
+            cb = ref()
+            if cb is subscriber or getattr(cb, '__self__', None) is subscriber:
+                del self._delta_callbacks[i]
+                return
+
+    def close(self):
+        '''
+        Detaches the operator from its inputs and drops its contents.
+        Operators that are merely dropped are detached once garbage
+        collected, close() does it right away.
+
+        Nodes built by filter() and the other masked_* helpers are shared
+        by everyone asking for the same subplan. Each of them should close
+        the node once, and it is only detached when the last one does.
+        '''
+        if self._shared_key is not None:
+            self._holders -= 1
+            if self._holders > 0:
+                return
+            if _shared_nodes.get(self._shared_key) is self:
+                del _shared_nodes[self._shared_key]
+            self._shared_key = None
+        self._detach()
+        self._tuples.clear()
+        self._indexes = {}
+        self._ordered = None
+        self._added = set()
+        self._removed = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _detach(self):
+        for rel in self._inputs():
+            rel._unsubscribe(self)
+
+    def _delivered(self):
+        if not self._added and not self._removed:
+            return set(self._tuples)
+        return (self._tuples - self._added) | self._removed
+
+    def _store_add(self, x):
+        scheduler = self._scheduler
+        if scheduler._committing:
+            with scheduler._undo_lock:
+                scheduler._record_undo(self, (x,), ())
+                self._tuples.add(x)
+        else:
+            self._tuples.add(x)
+        for key_of, index in self._indexes.values():
+            index[key_of(x)].add(x)
+        if self._ordered is not None:
+            self._ordered.add(x)
+
+    def _store_remove(self, x):
+        scheduler = self._scheduler
+        if scheduler._committing:
+            with scheduler._undo_lock:
+                scheduler._record_undo(self, (), (x,))
+                self._tuples.remove(x)
+        else:
+            self._tuples.remove(x)
+        for key_of, index in self._indexes.values():
+            key = key_of(x)
+            bucket = index[key]
+            bucket.remove(x)
+            if not bucket: del index[key]
+        if self._ordered is not None:
+            self._ordered.discard(x)
+
     def _self_add(self, x):
         if x not in self._tuples:
             if self._debug: print('add', self, x)
             self._changed = True
-            self._tuples.add(x)
-            for cb in self._add_callbacks:
-                run_later(cb, x)
+            self._store_add(x)
+            if x in self._removed:
+                self._removed.remove(x)
+            else:
+                self._added.add(x)
+            self._schedule_flush()
 
     def _self_remove(self, x):
         if x in self._tuples:
+            if self._debug: print('remove', self, x)
             self._changed = True
-            self._tuples.remove(x)
-            for cb in self._remove_callbacks:
-                run_later(cb, x)
-
-    def iter(self): # TODO
-        yield from sorted(self._tuples)
+            self._store_remove(x)
+            if x in self._added:
+                self._added.remove(x)
+            else:
+                self._removed.add(x)
+            self._schedule_flush()
+
+    def _self_update(self, added, removed):
+        # bulk variant of _self_add/_self_remove: `added` and `removed` are
+        # sets forming a net delta (added disjoint from _tuples, removed a subset)
+        if not added and not removed:
+            return
+        if self._debug: print('update', self, added, removed)
+        self._changed = True
+
+        scheduler = self._scheduler
+        if scheduler._committing:
+            with scheduler._undo_lock:
+                scheduler._record_undo(self, added, removed)
+                self._tuples -= removed
+                self._tuples |= added
+        else:
+            self._tuples -= removed
+            self._tuples |= added
+        for key_of, index in self._indexes.values():
+            for x in removed:
+                key = key_of(x)
+                bucket = index[key]
+                bucket.remove(x)
+                if not bucket: del index[key]
+            for x in added:
+                index[key_of(x)].add(x)
+        if self._ordered is not None:
+            for x in removed:
+                self._ordered.discard(x)
+            for x in added:
+                self._ordered.add(x)
+
+        readded = added & self._removed
+        self._removed -= readded
+        self._added |= added - readded
+
+        unadded = removed & self._added
+        self._added -= unadded
+        self._removed |= removed - unadded
+
+        self._schedule_flush()
+
+    def _self_apply(self, added, removed):
+        # removes the tuples in `removed`, then adds the ones in `added`
+        self._self_update(added - self._tuples, (removed & self._tuples) - added)
+
+    def _over_delete(self, ts):
+        # `ts` were removed even though they may still have another
+        # derivation; once sync() has propagated all removals, the ones
+        # for which _rederivable() holds are added back
+        if ts:
+            if not self._rederive:
+                self._scheduler._rederive_queue.append(self)
+            self._rederive |= ts
+
+    def _rederivable(self, t):
+        return False
+
+    def _rederive_pending(self):
+        ts = self._rederive
+        self._rederive = set()
+        self._self_update({ t for t in ts if t not in self._tuples and self._rederivable(t) }, set())
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._scheduler._schedule(self)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        removed = self._removed
+        self._removed = set()
+        if self._scheduler._deleting:
+            added = set()
+            if self._added:
+                self._scheduler._deferred.append(self)
+        else:
+            added = self._added
+            self._added = set()
+
+        if added or removed:
+            dead = False
+            for ref, args in list(self._delta_callbacks):
+                cb = ref()
+                if cb is None:
+                    dead = True
+                else:
+                    cb(*args, added, removed)
+            if dead:
+                self._delta_callbacks = [ entry for entry in self._delta_callbacks if entry[0]() is not None ]
+
+    def _get_ordered(self):
+        if self._ordered is None:
+            self._ordered = self.ordered_store(self._tuples)
+        return self._ordered
+
+    def iter(self):
+        yield from self._get_ordered().irange()
+
+    def iter_range(self, lo=None, hi=None):
+        '''Iterates over tuples t with lo <= t < hi in sorted order (None means unbounded).'''
+        yield from self._get_ordered().irange(lo, hi)
 
     def to_set(self):
         return set(self._tuples)
 
-    def iter_with_prefix(self, prefix): # TODO
-        for t in self.iter():
-            if t[:len(prefix)] == prefix:
-                yield t
+    def _state(self):
+        # operator specific state saved along with the tuples, see dlog_persist
+        return None
+
+    def _load_state(self, state):
+        pass
+
+    def _load(self, tuples, state):
+        # replaces the contents with saved ones, without delivering any delta
+        self._tuples.clear()
+        self._tuples |= set(tuples)
+        self._indexes = {}
+        self._ordered = None
+        self._added = set()
+        self._removed = set()
+        self._rederive = set()
+        self._load_state(state)
+
+    def statistics(self):
+        '''Cardinality statistics for the query planner.'''
+        distinct = []
+        for i in range(self.arity):
+            entry = self._indexes.get((i,))
+            if entry is not None:
+                distinct.append(len(entry[1]))
+            else:
+                # counted once rather than kept as an index, which would hold
+                # every tuple and be maintained forever
+                distinct.append(len({ t[i] for t in self._tuples }))
+
+        return RelationStats(count=len(self._tuples), distinct=tuple(distinct))
+
+    def _get_index(self, cols):
+        # secondary index: values of columns `cols` -> set of tuples, built on first use
+        entry = self._indexes.get(cols)
+        if entry is None:
+            key_of = _key_function(cols)
+            index = collections.defaultdict(set)
+            for t in self._tuples:
+                index[key_of(t)].add(t)
+            entry = self._indexes[cols] = (key_of, index)
+        return entry[1]
+
+    def _lookup(self, cols, key):
+        bucket = self._get_index(cols).get(key)
+        return tuple(bucket) if bucket else ()
+
+    def iter_with_prefix(self, prefix):
+        prefix = tuple(prefix)
+        if not prefix:
+            yield from list(self._tuples)
+            return
+
+        yield from self._lookup(tuple(range(len(prefix))), prefix)
 
     def contains(self, t):
         return t in self._tuples
@@ -60,9 +896,9 @@ class SimpleRelation:
             f(t)
 
 class DataRelation(SimpleRelation):
-    def __init__(self, arity):
+    def __init__(self, arity, *, storage=None, scheduler=None):
         self.arity = arity
-        super().__init__()
+        super().__init__(storage=storage, scheduler=scheduler)
 
     def add(self, x):
         self._self_add(x)
@@ -70,11 +906,41 @@ class DataRelation(SimpleRelation):
     def remove(self, x):
         self._self_remove(x)
 
-def single(t):
-    d = DataRelation(len(t))
+    def update(self, added=(), removed=()):
+        '''
+        Adds and removes many tuples at once. The net delta against the
+        current contents is computed first (a tuple both added and removed
+        is left alone) and reaches dependent operators as a single batch.
+        '''
+        added = set(added)
+        removed = set(removed)
+        both = added & removed
+        self._self_update(
+            added - both - self._tuples,
+            (removed - both) & self._tuples)
+
+    def add_many(self, xs):
+        self.update(added=xs)
+
+    def remove_many(self, xs):
+        self.update(removed=xs)
+
+    def replace_all(self, xs):
+        '''Replaces the contents of the relation with the tuples from `xs`.'''
+        new = set(xs)
+        self._self_update(new - self._tuples, self._tuples - new)
+
+def single(t, *, scheduler=None):
+    d = DataRelation(len(t), scheduler=scheduler)
     d.add(t)
     return d
 
+def _group_by_prefix(ts, k):
+    groups = collections.defaultdict(list)
+    for t in ts:
+        groups[t[:k]].append(t)
+    return groups
+
 def join_lists(a, b, join_k):
     A = collections.defaultdict(list)
 
@@ -86,48 +952,52 @@ def join_lists(a, b, join_k):
             yield t1 + t2[join_k:]
 
 class SimpleJoin(SimpleRelation):
-    def __init__(self, a, b, join_k):
+    def __init__(self, a, b, join_k, *, storage=None):
         self.a = a
         self.b = b
         self.join_k = join_k
         self.arity = self.a.arity + self.b.arity - self.join_k
 
-        super().__init__()
+        super().__init__(storage=storage)
 
     def _enable(self):
-        self.a._add_callbacks.append(self.__a_added)
-        self.a._remove_callbacks.append(self.__a_removed)
-
-        self.b._add_callbacks.append(self.__b_added)
-        self.b._remove_callbacks.append(self.__b_removed)
-
-        self.b.run_for_all(self.__b_added)
-        self.a.run_for_all(self.__a_added)
-
-    def __a_added(self, t):
-        for t1 in self.b.iter_with_prefix(t[:self.join_k]):
-            self._self_add(t + t1[self.join_k:])
-
-    def __a_removed(self, t):
-        for t1 in self.b.iter_with_prefix(t[:self.join_k]):
-            self.__remove_tuple_if_needed(t + t1[self.join_k:])
-
-    def __b_added(self, t):
-        for t1 in self.a.iter_with_prefix(t[:self.join_k]):
-            self._self_add(t1 + t[self.join_k:])
-
-    def __b_removed(self, t):
-        for t1 in self.a.iter_with_prefix(t[:self.join_k]):
-            self.__remove_tuple_if_needed(t1 + t[self.join_k:])
-
-    def __remove_tuple_if_needed(self, t):
-        if t in self._tuples and not self.__contains(t):
-            self._self_remove(t)
-
-    def __contains(self, t):
-        t1 = t[:self.a.arity]
-        t2 = t[:self.join_k] + t[self.a.arity:]
-        return self.a.contains(t1) and self.b.contains(t2)
+        self.b._subscribe(self.__b_changed)
+        self.a._subscribe(self.__a_changed)
+
+    def _inputs(self):
+        return [self.a, self.b]
+
+    def __a_changed(self, added, removed):
+        # each output tuple has exactly one derivation, so everything built
+        # from a removed tuple goes away with it
+        a_cols = tuple(range(self.a.arity))
+        gone = set()
+        for t in removed:
+            gone.update(self._lookup(a_cols, t))
+
+        k = self.join_k
+        out = set()
+        for key, ts in _group_by_prefix(added, k).items():
+            matching = list(self.b.iter_with_prefix(key))
+            for t in ts:
+                for t1 in matching:
+                    out.add(t + t1[k:])
+        self._self_apply(out, gone)
+
+    def __b_changed(self, added, removed):
+        k = self.join_k
+        b_cols = tuple(range(k)) + tuple(range(self.a.arity, self.arity))
+        gone = set()
+        for t in removed:
+            gone.update(self._lookup(b_cols, t))
+
+        out = set()
+        for key, ts in _group_by_prefix(added, k).items():
+            matching = list(self.a.iter_with_prefix(key))
+            for t in ts:
+                for t1 in matching:
+                    out.add(t1 + t[k:])
+        self._self_apply(out, gone)
 
     def get_origins(self, t):
         return [ [ (self.a, t[self.a.arity]), (self.b, t[:self.join_k] + t[self.a.arity:]) ] ]
@@ -138,6 +1008,21 @@ def project(t, new_axes):
         r.append(t[i])
     return tuple(r)
 
+def _key_function(cols):
+    if cols == tuple(range(len(cols))):
+        k = len(cols)
+        return lambda t: t[:k]
+    return _projector(cols)
+
+def _projector(new_axes):
+    # fast equivalent of `lambda t: project(t, new_axes)`
+    if len(new_axes) == 0:
+        return lambda t: ()
+    if len(new_axes) == 1:
+        i, = new_axes
+        return lambda t: (t[i], )
+    return operator.itemgetter(*new_axes)
+
 def unproject(t, new_axes):
     r = []
     for i in new_axes:
@@ -145,83 +1030,509 @@ def unproject(t, new_axes):
     return tuple(r)
 
 class SimpleProjection(SimpleRelation):
-    def __init__(self, a, new_axes):
+    def __init__(self, a, new_axes, *, storage=None):
         self.a = a
         self.new_axes = new_axes
         self.arity = len(new_axes)
+        self._project = _projector(new_axes)
 
-        super().__init__()
-
-    def _enable(self):
-        self.a._add_callbacks.append(self.__added)
-        self.a._remove_callbacks.append(self.__removed)
-        self.a.run_for_all(self.__added)
+        # number of tuples of `a` projecting onto each output tuple; kept
+        # compact - an output tuple without an entry has exactly one (or
+        # none if it isn't in _tuples). Over-deleted tuples keep an entry
+        # while they are out of _tuples.
+        self.counts = {}
 
-    def __added(self, t):
-        self._self_add(project(t, self.new_axes))
+        super().__init__(storage=storage)
 
-    def __removed(self, t):
-        self._self_remove(project(t, self.new_axes))
+    def _enable(self):
+        self.a._subscribe(self.__changed)
+
+    def _inputs(self):
+        return [self.a]
+
+    def __changed(self, added, removed):
+        counts = self.counts
+        tuples = self._tuples
+        if not removed:
+            out_added = set()
+            for t in map(self._project, added):
+                if t in counts:
+                    counts[t] += 1
+                    if t not in tuples:
+                        out_added.add(t)
+                elif t in tuples or t in out_added:
+                    counts[t] = 2
+                else:
+                    out_added.add(t)
+            self._self_update(out_added, set())
+            return
+
+        delta = collections.Counter(map(self._project, added))
+        delta.subtract(map(self._project, removed))
+        _apply_support(self, delta)
+
+    def _rederivable(self, t):
+        return self.counts.get(t, 0) > 0
+
+    def _state(self):
+        return self.counts
+
+    def _load_state(self, state):
+        self.counts = dict(state)
 
     # def get_origins(self, t):
     #     pass # ???
 
+def _apply_support(rel, delta):
+    # applies changes of support counts (output tuple -> change) to a
+    # relation with compact `counts` as kept by SimpleProjection
+    counts = rel.counts
+    tuples = rel._tuples
+    out_added = set()
+    out_removed = set()
+    over_deleted = set()
+    for t, d in delta.items():
+        if not d:
+            continue
+        count = counts[t] if t in counts else (1 if t in tuples else 0)
+        count += d
+        if count <= 0:
+            counts.pop(t, None)
+            if t in tuples:
+                out_removed.add(t)
+        elif d < 0 and rel._recursive:
+            # the remaining support may depend on t through the cycle
+            counts[t] = count
+            if t in tuples:
+                over_deleted.add(t)
+        else:
+            if count == 1:
+                counts.pop(t, None)
+            else:
+                counts[t] = count
+            if t not in tuples:
+                out_added.add(t)
+
+    rel._self_apply(out_added, out_removed | over_deleted)
+    rel._over_delete(over_deleted)
+
+class _KeyRouter:
+    '''
+    Delivers the deltas of `rel` only to the operators registered for their
+    values of columns `cols`, instead of every operator seeing every delta.
+    Operators are held weakly and receive deltas through _routed().
+    '''
+
+    def __init__(self, rel, cols):
+        self.key_of = _key_function(cols)
+        # key -> operators
+        self.routes = {}
+        rel._subscribe(self.__changed)
+
+    def add(self, key, node):
+        nodes = self.routes.get(key)
+        if nodes is None:
+            nodes = self.routes[key] = weakref.WeakSet()
+        nodes.add(node)
+
+    def remove(self, key, node):
+        nodes = self.routes.get(key)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self.routes[key]
+
+    def _downstream(self):
+        return list({ node for nodes in self.routes.values() for node in nodes })
+
+    def __changed(self, added, removed):
+        if not self.routes:
+            return
+        deltas = {}
+        for ts, i in ((added, 0), (removed, 1)):
+            for t in ts:
+                for node in self.routes.get(self.key_of(t), ()):
+                    if node not in deltas:
+                        deltas[node] = (set(), set())
+                    deltas[node][i].add(t)
+        for node, (node_added, node_removed) in deltas.items():
+            node._routed(node_added, node_removed)
+
+class SimpleArbitraryJoin(SimpleRelation):
+    '''
+    Join of `a` and `b` producing the columns given by `axes` directly: an
+    (i, j) entry is a column where a[i] == b[j], (i, None) and (None, j)
+    take column i of `a` or j of `b`. Inputs are looked up through their
+    own indexes on the join columns, and since columns may be dropped,
+    output tuples are counted like in SimpleProjection.
+
+    With a `router` (a _KeyRouter of `a` on the join columns), deltas of
+    `a` are only delivered for the keys present in `b`.
+    '''
+
+    def __init__(self, a, b, axes, *, router=None, storage=None):
+        self.a = a
+        self.b = b
+        self.axes = tuple(axes)
+        self.arity = len(self.axes)
+        join_on = [ (i, j) for i, j in self.axes if i is not None and j is not None ]
+        self.a_cols = tuple( i for i, j in join_on )
+        self.b_cols = tuple( j for i, j in join_on )
+        # output from the concatenation of an `a` and a `b` tuple
+        self._build = _projector([ i if i is not None else a.arity + j for i, j in self.axes ])
+        self.counts = {}
+        self.__loading = False
+        self.router = router
+        # join key -> number of b tuples with it, while routed
+        self.__keys = collections.Counter()
+
+        super().__init__(storage=storage)
+
+    def _enable(self):
+        if self.router is not None:
+            # b's initial contents are matched against all of a
+            self.b._subscribe(self.__b_changed)
+        elif self.a is self.b:
+            self.a._subscribe(self.__self_changed)
+        else:
+            # b's initial contents are matched when a subscribes
+            self.__loading = True
+            self.b._subscribe(self.__b_changed)
+            self.__loading = False
+            self.a._subscribe(self.__a_changed)
+
+    def _inputs(self):
+        return [self.a, self.b]
+
+    def __a_changed(self, added, removed):
+        delta = collections.Counter()
+        self.__match(delta, True, added, removed, self.b._added, self.b._removed)
+        _apply_support(self, delta)
+
+    def _routed(self, added, removed):
+        self.__a_changed(added, removed)
+
+    def __b_changed(self, added, removed):
+        if self.__loading:
+            return
+        delta = collections.Counter()
+        self.__match(delta, False, added, removed, self.a._added, self.a._removed)
+        _apply_support(self, delta)
+        if self.router is not None:
+            self.__route(added, removed)
+
+    def __route(self, added, removed):
+        # receive deltas of `a` exactly for the keys b has
+        keys = self.__keys
+        key_of = _key_function(self.b_cols)
+        for t in added:
+            key = key_of(t)
+            keys[key] += 1
+            if keys[key] == 1:
+                self.router.add(key, self)
+        for t in removed:
+            key = key_of(t)
+            keys[key] -= 1
+            if not keys[key]:
+                del keys[key]
+                self.router.remove(key, self)
+
+    def __unroute(self):
+        for key in self.__keys:
+            self.router.remove(key, self)
+        self.__keys.clear()
+
+    def _detach(self):
+        if self.router is not None:
+            self.__unroute()
+        super()._detach()
+
+    def __self_changed(self, added, removed):
+        # as if `a` changed first, while `b` is still the old contents
+        delta = collections.Counter()
+        self.__match(delta, True, added, removed, added | self.a._added, removed | self.a._removed)
+        self.__match(delta, False, added, removed, self.a._added, self.a._removed)
+        _apply_support(self, delta)
+
+    def __match(self, delta, a_side, added, removed, unseen_added, unseen_removed):
+        # joins a delta of one input with the contents of the other one that
+        # this operator has seen: its index, minus tuples not delivered yet
+        # (unseen_added) plus tuples removed but not delivered yet
+        if a_side:
+            other, cols, other_cols = self.b, self.a_cols, self.b_cols
+        else:
+            other, cols, other_cols = self.a, self.b_cols, self.a_cols
+        index = other._get_index(other_cols)
+        key_of = _key_function(cols)
+        other_key_of = _key_function(other_cols)
+        unseen_removed_by_key = collections.defaultdict(list)
+        for t in unseen_removed:
+            unseen_removed_by_key[other_key_of(t)].append(t)
+
+        build = self._build
+        for ts, sign in ((removed, -1), (added, 1)):
+            by_key = collections.defaultdict(list)
+            for t in ts:
+                by_key[key_of(t)].append(t)
+
+            for key, group in by_key.items():
+                matching = index.get(key, ())
+                if unseen_added:
+                    matching = [ t for t in matching if t not in unseen_added ]
+                matching = list(matching) + unseen_removed_by_key.get(key, [])
+                for t in group:
+                    for t1 in matching:
+                        delta[build(t + t1 if a_side else t1 + t)] += sign
+
+    def _rederivable(self, t):
+        return self.counts.get(t, 0) > 0
+
+    def _state(self):
+        return self.counts
+
+    def _load_state(self, state):
+        self.counts = dict(state)
+        if self.router is not None:
+            # b was loaded before, without delivering its tuples
+            self.__unroute()
+            self.__route(self.b._tuples, ())
+
 class SimpleUnion(SimpleRelation):
-    def __init__(self, rels=None, *, arity=None):
+    def __init__(self, rels=None, *, arity=None, storage=None, scheduler=None):
         assert rels or arity is not None
         self.arity = arity if arity is not None else rels[0].arity
         self.rels = list(rels or [])
-        for r in rels: assert r.arity == self.arity
+        for r in self.rels: assert r.arity == self.arity
 
         self.counts = collections.defaultdict(int)
-        super().__init__()
+        super().__init__(storage=storage, scheduler=scheduler)
 
     def _enable(self):
         for r in self.rels:
-            r._add_callbacks.append(self.__added)
-            r._remove_callbacks.append(self.__removed)
+            r._subscribe(self.__changed)
+
+    def _inputs(self):
+        return list(self.rels)
+
+    def add_input(self, rel):
+        '''Adds another input relation, its current tuples arrive as an addition.'''
+        if any( r is rel for r in self.rels ):
+            return
+        _check_same_graph(self._scheduler, [rel])
+        self.rels.append(rel)
+        self._scheduler._raise_rank(self, rel._rank + 1)
+        rel._subscribe(self.__changed)
+
+    def remove_input(self, rel):
+        '''Removes an input, retracting the tuples it contributed.'''
+        for i, r in enumerate(self.rels):
+            if r is rel:
+                del self.rels[i]
+                rel._unsubscribe(self)
+                self.__changed(set(), rel._delivered())
+                return
+
+    def __changed(self, added, removed):
+        counts = self.counts
+        out_removed = set()
+        over_deleted = set()
+        for t in removed:
+            counts[t] -= 1
+            if counts[t] == 0:
+                del counts[t]
+                out_removed.add(t)
+            elif self._recursive and not self.__well_founded(t):
+                # the remaining support may be circular (t deriving itself
+                # through the cycle), so delete now and rederive later
+                over_deleted.add(t)
+
+        out_added = set()
+        for t in added:
+            counts[t] += 1
+            if counts[t] == 1:
+                out_added.add(t)
+
+        self._self_apply(out_added, out_removed | over_deleted)
+        self._over_delete(over_deleted - self._tuples)
+
+    def __well_founded(self, t):
+        return any( not r._recursive and r.contains(t) for r in self.rels )
+
+    def _rederivable(self, t):
+        return self.counts.get(t, 0) > 0
+
+    def _state(self):
+        return dict(self.counts)
+
+    def _load_state(self, state):
+        self.counts = collections.defaultdict(int, state)
 
+    @genlist
+    def get_origins(self, t):
         for r in self.rels:
-            r.run_for_all(self.__added)
+            if r.contains(t):
+                yield (r, t)
 
-    def __added(self, t):
-        self.counts[t] += 1
-        self._self_add(t)
+_UNBOUND = object()
 
-    def __removed(self, t):
-        self.counts[t] -= 1
-        if self.counts[t] == 0:
-            del self.counts[t]
-            self._self_remove(t)
+class SimpleMultiJoin(SimpleRelation):
+    '''
+    Joins any number of relations at once, one variable at a time (Generic
+    Join). `atoms` is a list of (relation, vars) pairs where vars[i] is the
+    variable bound by column i of the relation; the result has one column
+    per variable 0..n_vars-1. Unlike a tree of binary joins, cyclic queries
+    such as triangles never materialize large intermediate results.
 
-    @genlist
-    def get_origins(self, t):
-        for r in rels:
-            if r.contains(r):
-                yield (r, t)
+    Deltas are handled by binding the variables of each changed tuple and
+    joining the remaining ones against the current inputs.
+    '''
+
+    def __init__(self, atoms, n_vars, *, storage=None):
+        self.atoms = [ (rel, tuple(vars)) for rel, vars in atoms ]
+        self.arity = n_vars
+        for rel, vars in self.atoms:
+            assert len(vars) == rel.arity
+        if { v for rel, vars in self.atoms for v in vars } != set(range(n_vars)):
+            raise ValueError('every variable has to appear in some atom')
+
+        self.__loading = False
+        super().__init__(storage=storage)
+
+    def _inputs(self):
+        result = []
+        for rel, vars in self.atoms:
+            if not any( rel is r for r in result ):
+                result.append(rel)
+        return result
+
+    def _enable(self):
+        # one full join instead of a delta per input for the initial contents
+        self.__loading = True
+        for rel in self._inputs():
+            rel._subscribe(self.__changed, rel)
+        self.__loading = False
+
+        out = set()
+        self.__join([_UNBOUND] * self.arity, out)
+        self._self_update(out, set())
+
+    def __changed(self, rel, added, removed):
+        if self.__loading:
+            return
+
+        gone = set()
+        out = set()
+        for atom_rel, vars in self.atoms:
+            if atom_rel is not rel:
+                continue
+
+            out_cols = tuple(sorted(set(vars)))
+            for t in removed:
+                binding = self.__bind(vars, t)
+                # a tuple disagreeing on a repeated variable never matched
+                if binding is not None:
+                    gone.update(self._lookup(out_cols, tuple( binding[v] for v in out_cols )))
+
+            for t in added:
+                binding = self.__bind(vars, t)
+                if binding is not None:
+                    self.__join(binding, out)
+
+        self._self_apply(out, gone)
+
+    def __bind(self, vars, t):
+        # variables bound by tuple `t` of an atom, None if t gives a repeated
+        # variable two different values
+        binding = [_UNBOUND] * self.arity
+        for v, x in zip(vars, t):
+            if binding[v] is _UNBOUND:
+                binding[v] = x
+            elif binding[v] != x:
+                return None
+        return binding
+
+    def __matching(self, rel, vars, binding):
+        # tuples of `rel` agreeing with the bound variables
+        cols = tuple( c for c, v in enumerate(vars) if binding[v] is not _UNBOUND )
+        if not cols:
+            return rel._tuples
+        return rel._get_index(cols).get(tuple( binding[vars[c]] for c in cols ), ())
+
+    def __join(self, binding, out):
+        if all( self.__matching(rel, vars, binding) for rel, vars in self.atoms ):
+            self.__extend(binding, out)
+
+    def __extend(self, binding, out):
+        var = next(( v for v in range(self.arity) if binding[v] is _UNBOUND ), None)
+        if var is None:
+            out.add(tuple(binding))
+            return
+
+        atoms = [ (rel, vars) for rel, vars in self.atoms if var in vars ]
+        # candidate values come from the atom with the fewest matching tuples,
+        # the other atoms only have to be probed
+        buckets = [ self.__matching(rel, vars, binding) for rel, vars in atoms ]
+        i = min(range(len(atoms)), key=lambda i: len(buckets[i]))
+        cols = [ c for c, v in enumerate(atoms[i][1]) if v == var ]
+        values = { t[cols[0]] for t in buckets[i] if all( t[c] == t[cols[0]] for c in cols[1:] ) }
+        others = atoms[:i] + atoms[i + 1:]
+
+        for x in values:
+            binding[var] = x
+            if all( self.__matching(rel, vars, binding) for rel, vars in others ):
+                self.__extend(binding, out)
+        binding[var] = _UNBOUND
+
+@dataclasses.dataclass
+class FixpointStats:
+    iterations: int = 0
+    derived: int = 0
 
 class SimpleLink(SimpleRelation):
-    def __init__(self, arity):
+    '''
+    Closes a recursive cycle: the link stands in for the relation `a` that
+    is later passed to link() and mirrors its contents.
+
+    Evaluation of the cycle is semi-naive - every flush of the link delivers
+    only the tuples that are new since the previous iteration, and joins
+    match that delta against the full contents of their other input.
+    Progress is recorded in `stats`.
+    '''
+
+    def __init__(self, arity, *, storage=None, scheduler=None):
         self.arity = arity
         self.a = None
+        self.stats = FixpointStats()
 
-        super().__init__()
+        super().__init__(storage=storage, scheduler=scheduler)
 
     def _enable(self):
         # FIXME: enable logic
         pass
 
     def link(self, a):
+        _check_same_graph(self._scheduler, [a])
         self.a = a
-        self.a._add_callbacks.append(self.__added)
-        self.a._remove_callbacks.append(self.__removed)
-        self.a.run_for_all(self.__added)
+        for node in _cycle_members(self):
+            node._recursive = True
+        self._scheduler._rerank()
+        self.a._subscribe(self.__changed)
+
+    def _inputs(self):
+        return [self.a] if self.a is not None else []
+
+    def _state(self):
+        return self.stats
 
-    def __added(self, t):
-        self._self_add(t)
+    def _load_state(self, state):
+        self.stats = state
 
-    def __removed(self, t):
-        self._self_remove(t)
+    def __changed(self, added, removed):
+        new = added - self._tuples
+        if new:
+            self.stats.iterations += 1
+            self.stats.derived += len(new)
+        self._self_update(new, (removed & self._tuples) - added)
 
     def get_origins(self, t):
         if self.a is None:
@@ -229,6 +1540,36 @@ class SimpleLink(SimpleRelation):
         else:
             return self.a.get_origins(t)
 
+def _cycle_members(link):
+    # operators lying on a path from `link` back to itself
+    return _nodes_between(link, link.a) | {link}
+
+def _nodes_between(src, dst):
+    # operators lying on a path from `src` to `dst` (both included)
+    upstream = []
+    seen = set()
+    stack = [dst]
+    while stack:
+        node = stack.pop()
+        if node not in seen:
+            seen.add(node)
+            upstream.append(node)
+            stack.extend(node._inputs())
+
+    if src not in seen:
+        return set()
+
+    members = {src}
+    changed = True
+    while changed:
+        changed = False
+        for node in upstream:
+            if node not in members and any( i in members for i in node._inputs() ):
+                members.add(node)
+                changed = True
+
+    return members
+
 def _unproject(t, axes):
     res = []
     for i in axes:
@@ -239,46 +1580,352 @@ def _unproject(t, axes):
     return tuple(res)
 
 
+class FunctionCache:
+    '''
+    Memo table for the results of external functions, keyed by (function,
+    argument tuple), so one cache can be shared by several functions. Holds
+    at most `capacity` entries (None means unbounded), evicting
+    the least recently ('lru') or least frequently ('lfu') used one.
+    '''
+
+    def __init__(self, capacity=None, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('unknown eviction policy %r' % policy)
+        self.capacity = capacity
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        # lfu bookkeeping: key -> use count, use count -> keys (oldest first)
+        self._freq = {}
+        self._by_freq = collections.defaultdict(collections.OrderedDict)
+        self._min_freq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        '''Returns (True, value) on a hit and (False, None) on a miss.'''
+        if key not in self._entries:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        if self.policy == 'lru':
+            self._entries.move_to_end(key)
+        else:
+            self.__bump(key)
+        return True, self._entries[key]
+
+    def store(self, key, value):
+        if key in self._entries:
+            self._entries[key] = value
+            return
+        if self.capacity is not None:
+            if self.capacity <= 0:
+                return
+            while len(self._entries) >= self.capacity:
+                self.__evict()
+
+        self._entries[key] = value
+        if self.policy == 'lfu':
+            self._freq[key] = 1
+            self._by_freq[1][key] = None
+            self._min_freq = 1
+
+    def call(self, f, args):
+        found, value = self.lookup((f, args))
+        if not found:
+            value = f(*args)
+            self.store((f, args), value)
+        return value
+
+    def __bump(self, key):
+        freq = self._freq[key]
+        keys = self._by_freq[freq]
+        del keys[key]
+        if not keys:
+            del self._by_freq[freq]
+            if self._min_freq == freq:
+                self._min_freq = freq + 1
+        self._freq[key] = freq + 1
+        self._by_freq[freq + 1][key] = None
+
+    def __evict(self):
+        if self.policy == 'lru':
+            self._entries.popitem(last=False)
+        else:
+            keys = self._by_freq[self._min_freq]
+            key, _ = keys.popitem(last=False)
+            if not keys:
+                del self._by_freq[self._min_freq]
+            del self._freq[key]
+            del self._entries[key]
+
+EXECUTION_POLICIES = ('inline', 'threads', 'processes', 'asyncio')
+
+# pools shared by all external functions, keyed by (policy, max_workers)
+_executors = {}
+
+def _get_executor(policy, max_workers):
+    key = (policy, max_workers)
+    if key not in _executors:
+        if policy == 'threads':
+            _executors[key] = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            _executors[key] = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    return _executors[key]
+
+def _apply(f, args):
+    return f(*args)
+
+def _call_all(f, args_list, policy, max_workers=None):
+    '''
+    Returns [ f(*args) for args in args_list ], with the calls made according
+    to `policy` (one of EXECUTION_POLICIES). For 'processes', f must be
+    picklable; for 'asyncio', f must be a coroutine function and no event
+    loop may be running in the calling thread.
+    '''
+    if policy == 'inline':
+        return [ f(*args) for args in args_list ]
+    elif policy == 'asyncio':
+        async def gather():
+            return await asyncio.gather(*( f(*args) for args in args_list ))
+        return asyncio.run(gather())
+    elif policy in ('threads', 'processes'):
+        executor = _get_executor(policy, max_workers)
+        chunksize = max(1, len(args_list) // (4 * (max_workers or os.cpu_count() or 1)))
+        return list(executor.map(_apply, [f] * len(args_list), args_list, chunksize=chunksize))
+    else:
+        raise ValueError('unknown execution policy %r' % policy)
+
 class SimpleExternalFunction(SimpleRelation):
-    def __init__(self, *, a, has_value, f, f_arity):
+    def __init__(self, *, a, has_value, f, f_arity, cache=None, vectorized=False,
+                 policy='inline', max_workers=None, storage=None):
         self.a = a
         self.f = f
         self._has_value = has_value
         self.f_arity = f_arity
         self.arity = f_arity + 1
+        self.cache = cache
+        # f takes one column (list) per argument and returns a column of results
+        self.vectorized = vectorized
+        if policy not in EXECUTION_POLICIES:
+            raise ValueError('unknown execution policy %r' % policy)
+        self.policy = policy
+        self.max_workers = max_workers
 
         self._values = {}
 
-        super().__init__()
+        super().__init__(storage=storage)
 
     def _enable(self):
-        self.a._add_callbacks.append(self.__added)
-        self.a._remove_callbacks.append(self.__removed)
-        self.a.run_for_all(self.__added)
-
-    def __added(self, t):
-        key = t[:self.f_arity]
-        value = self.f(*key)
-        if not self._has_value or t[-1] == value:
-            self._values[key] = value
-            self._self_add((*key, value))
-
-    def __removed(self, t):
-        if self._has_value:
-            self._self_remove(t)
-        else:
+        self.a._subscribe(self.__changed)
+
+    def _inputs(self):
+        return [self.a]
+
+    def _state(self):
+        return self._values
+
+    def _load_state(self, state):
+        self._values = dict(state)
+
+    def __changed(self, added, removed):
+        out_removed = set()
+        for t in removed:
+            if self._has_value:
+                out_removed.add(t)
+            else:
+                key = t[:self.f_arity]
+                out_removed.add((*key, self._values.pop(key)))
+
+        values = self.__evaluate({ t[:self.f_arity] for t in added })
+        out_added = set()
+        for t in added:
             key = t[:self.f_arity]
-            self._self_remove((*key, self._values[key]))
-            del self._values[key]
+            value = values[key]
+            if not self._has_value or t[-1] == value:
+                self._values[key] = value
+                out_added.add((*key, value))
+
+        self._self_apply(out_added, out_removed)
+
+    def __evaluate(self, keys):
+        values = {}
+        missing = []
+        for key in keys:
+            if self.cache is not None:
+                found, value = self.cache.lookup((self.f, key))
+                if found:
+                    values[key] = value
+                    continue
+            missing.append(key)
+
+        if not missing:
+            return values
+
+        if self.vectorized:
+            # pools get one slice of the columns per worker
+            if self.policy in ('threads', 'processes'):
+                n = self.max_workers or os.cpu_count() or 1
+                size = -(-len(missing) // n)
+                chunks = [ missing[i:i + size] for i in range(0, len(missing), size) ]
+            else:
+                chunks = [missing]
+
+            args_list = [ tuple( list(column) for column in zip(*chunk) ) for chunk in chunks ]
+            results = []
+            for chunk, chunk_results in zip(chunks, _call_all(self.f, args_list, self.policy, self.max_workers)):
+                chunk_results = chunk_results.tolist() if hasattr(chunk_results, 'tolist') else list(chunk_results)
+                if len(chunk_results) != len(chunk):
+                    raise ValueError('vectorized %r returned %d results for %d keys' % (self.f, len(chunk_results), len(chunk)))
+                results += chunk_results
+        else:
+            results = _call_all(self.f, missing, self.policy, self.max_workers)
+
+        for key, value in zip(missing, results):
+            if self.cache is not None:
+                self.cache.store((self.f, key), value)
+            values[key] = value
+
+        return values
+
+# live operator nodes by (type, inputs, parameters); equal subplans built by
+# different rules or filter() calls share one node
+_shared_nodes = weakref.WeakValueDictionary()
+
+def _freeze(x):
+    if isinstance(x, (list, tuple)):
+        return tuple( _freeze(y) for y in x )
+    return x
+
+def _shared(cls, *args, **kwargs):
+    '''
+    Returns the live node cls(*args, **kwargs) if one was already built with
+    the same inputs (compared by identity) and parameters, or builds it.
+    Only for operators without mutable state of their own - never
+    DataRelation or SimpleLink.
+    '''
+    key = (cls, _freeze(args), _freeze(sorted(kwargs.items())))
+    try:
+        node = _shared_nodes.get(key)
+    except TypeError:
+        # unhashable parameter, can't be shared
+        return cls(*args, **kwargs)
+
+    if node is None:
+        node = _shared_nodes[key] = cls(*args, **kwargs)
+        node._shared_key = key
+    node._holders += 1
+    return node
+
+class _MagicSet:
+    '''
+    Union of all demand seen with one binding mask and the answers to it,
+    shared by structurally equal relations of one graph.
+    '''
+
+    def __init__(self, demand, answers):
+        self.demand = demand
+        self.answers = answers
+        # demand relation -> number of answer nodes handed out for it
+        self.users = collections.Counter()
+        # answer relation -> _KeyRouter on the columns bound by the demand
+        self.routers = {}
+
+    def _router(self, a_masked, cols):
+        router = self.routers.get(a_masked)
+        if router is None:
+            router = self.routers[a_masked] = _KeyRouter(a_masked, cols)
+        return router
+
+    def _add(self, f_masked):
+        self.users[f_masked] += 1
+        self.demand.add_input(f_masked)
+
+    def _withdraw(self, f_masked):
+        self.users[f_masked] -= 1
+        if not self.users[f_masked]:
+            del self.users[f_masked]
+            self.demand.remove_input(f_masked)
+
+# live magic sets by (relation structure, mask, scheduler)
+_magic_set_registry = weakref.WeakValueDictionary()
 
 class Relation:
     def __init__(self):
+        # (mask, scheduler) -> _MagicSet
         self._magic_sets = {}
 
         super().__init__()
 
-    def __add_magic_set(self, mask, mask_magic_set):
-        pass
+    def _structure(self):
+        # hashable description of the relation; relations with equal
+        # structure have equal contents and share their magic sets
+        return self
+
+    def __add_magic_set(self, mask, scheduler):
+        try:
+            key = (self._structure(), mask, scheduler)
+            magic = _magic_set_registry.get(key)
+        except TypeError:
+            # unhashable parameter, can't be shared
+            key = None
+            magic = None
+
+        if magic is None:
+            demand = SimpleUnion(arity=self.arity, scheduler=scheduler)
+            magic = _MagicSet(demand, self._masked_filter([ (mask, demand) ]))
+            if key is not None:
+                _magic_set_registry[key] = magic
+
+        self._magic_sets[mask, scheduler] = magic
+        return magic
+
+    def masked_filter(self, f):
+        '''
+        Answers demand given as a list of (mask, relation) pairs, the relation
+        holding requested values of the columns set in mask. Answers are
+        computed once per mask (by _masked_filter of the subclass) for the
+        union of all demand with that mask; new demand just grows the union.
+        '''
+        result = []
+        for mask, f_masked in f:
+            mask = tuple(mask)
+            scheduler = f_masked._scheduler
+            magic = self._magic_sets.get((mask, scheduler)) or self.__add_magic_set(mask, scheduler)
+
+            for a_mask, a_masked in magic.answers:
+                # keep only the answers to this particular demand, new answers
+                # are routed by the demand values they match
+                cols = tuple( i for i in range(self.arity) if mask[i] and a_mask[i] )
+                answered = _shared(SimpleArbitraryJoin, a_masked, f_masked, [
+                    (i, i) if mask[i] and a_mask[i] else (None, i) if mask[i] else (i, None)
+                    for i in range(self.arity)
+                ], router=magic._router(a_masked, cols))
+                # the demand is withdrawn once nobody uses its answers - on
+                # the next sync(), not inside the garbage collector
+                magic._add(f_masked)
+                weakref.finalize(answered, scheduler.run_later, magic._withdraw, f_masked)
+                result.append((tuple( a or m for a, m in zip(a_mask, mask) ), answered))
+
+        return reduce_masked(result)
+
+    def statistics(self):
+        # unknown unless the relation is backed by a materialized one
+        return None
+
+    def close(self):
+        # answers are detached once the callers drop them too
+        self._magic_sets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def filter(self, a):
         result = self.masked_filter(a)
@@ -293,7 +1940,7 @@ def reduce_masked(a):
     for mask, a_masked in a: by_mask[mask].append(a_masked)
 
     return [
-        (mask, (lst[0] if len(lst) == 1 else SimpleUnion(lst)))
+        (mask, (lst[0] if len(lst) == 1 else _shared(SimpleUnion, lst)))
         for mask, lst in by_mask.items()
     ]
 
@@ -302,7 +1949,7 @@ def masked_projection(a, new_axes):
     for mask, a_masked in a:
         result.append((
             tuple( mask[a] for a in new_axes ),
-            SimpleProjection(a_masked, new_axes),
+            _shared(SimpleProjection, a_masked, new_axes),
         ))
 
     return reduce_masked(result)
@@ -310,15 +1957,7 @@ def masked_projection(a, new_axes):
 def simple_arbitrary_join(r_a, r_b, axes):
     assert isinstance(r_a, SimpleRelation)
     assert isinstance(r_b, SimpleRelation)
-    join_on = [ (a, b) for a, b in axes if a is not None and b is not None ]
-    join_on_a = [ a for a, b in join_on ]
-    join_on_b = [ b for a, b in join_on ]
-    join = SimpleJoin(
-        SimpleProjection(r_a, tuple(join_on_a) + tuple(range(r_a.arity))),
-        SimpleProjection(r_b, tuple(join_on_b) + tuple(range(r_b.arity))),
-        len(join_on)
-    )
-    return SimpleProjection(join, [ (a + len(join_on)) if a is not None else (b + len(join_on) + r_a.arity) for a, b in axes ])
+    return _shared(SimpleArbitraryJoin, r_a, r_b, axes)
 
 def _masked_intersect_prefix(prefix, a):
     result = []
@@ -342,7 +1981,13 @@ class NotSimple(Relation):
 
         super().__init__()
 
-    def masked_filter(self, f):
+    def statistics(self):
+        return self.a.statistics()
+
+    def _structure(self):
+        return (NotSimple, self.a)
+
+    def _masked_filter(self, f):
         result = []
         for mask, a_masked in f:
             joined = simple_arbitrary_join(
@@ -381,15 +2026,97 @@ class Join(Relation):
 
         super().__init__()
 
-    def masked_filter(self, f):
+    def _structure(self):
+        return (Join, self.a._structure(), self.b._structure(), self.join_k)
+
+    def _masked_filter(self, f):
         a_filtered = self.a.filter(masked_projection(f, tuple(range(self.a.arity))))
 
-        m_prefix = SimpleProjection(a_filtered, tuple(range(0, self.join_k)))
+        m_prefix = _shared(SimpleProjection, a_filtered, tuple(range(0, self.join_k)))
         m = masked_projection(f, tuple(range(0, self.join_k)) + tuple(range(self.a.arity, self.arity)))
 
         b_filtered = self.b.masked_filter(_masked_intersect_prefix(m_prefix, m))
         return _masked_join(a_filtered, b_filtered, self.join_k)
 
+class MultiJoin(Relation):
+    def __init__(self, atoms, n_vars):
+        self.atoms = [ (rel, tuple(vars)) for rel, vars in atoms ]
+        self.arity = n_vars
+
+        super().__init__()
+
+    def _structure(self):
+        return (MultiJoin, tuple( (rel._structure(), vars) for rel, vars in self.atoms ), self.arity)
+
+    def _masked_filter(self, f):
+        result = []
+        for mask, f_masked in f:
+            result.append(self.__answer(mask, f_masked))
+
+        return reduce_masked(result)
+
+    def __answer(self, mask, f_masked):
+        # The values of the variables bound by the demand are passed down to
+        # the atoms, which are then joined all at once. Atoms that can't be
+        # enumerated that way (e.g. an external function whose arguments are
+        # bound by other atoms) are joined in one by one afterwards, with
+        # the variables bound so far as their demand.
+        scheduler = f_masked._scheduler
+        bound = [ v for v in range(self.arity) if mask[v] ]
+        ready = []
+        if bound:
+            ready.append((_shared(SimpleProjection, f_masked, bound), bound))
+
+        later = []
+        for rel, vars in self.atoms:
+            atom_mask = tuple( mask[v] for v in vars )
+            if any(atom_mask):
+                demand = _shared(SimpleProjection, f_masked, [ v if mask[v] else 0 for v in vars ])
+            else:
+                demand = single((None,) * rel.arity, scheduler=scheduler)
+            answers = _enumerated(rel.masked_filter([ (atom_mask, demand) ]))
+            if answers is None:
+                later.append((rel, vars))
+            else:
+                ready.append((answers, vars))
+
+        if not ready:
+            return ((0,) * self.arity, DataRelation(arity=self.arity, scheduler=scheduler))
+
+        cur_vars = sorted({ v for rel, vars in ready for v in vars })
+        cur = _shared(SimpleMultiJoin, [
+            (rel, [ cur_vars.index(v) for v in vars ]) for rel, vars in ready
+        ], len(cur_vars))
+
+        while later:
+            for rel, vars in later:
+                atom_mask = tuple( int(v in cur_vars) for v in vars )
+                demand = _shared(SimpleProjection, cur, [ cur_vars.index(v) if v in cur_vars else 0 for v in vars ])
+                answers = _enumerated(rel.masked_filter([ (atom_mask, demand) ]))
+                if answers is not None:
+                    break
+            else:
+                # some atom can't be answered with what the others bind
+                return ((0,) * self.arity, DataRelation(arity=self.arity, scheduler=scheduler))
+
+            later.remove((rel, vars))
+            new_vars = cur_vars + sorted(set(vars) - set(cur_vars))
+            cur = simple_arbitrary_join(cur, answers, [
+                (cur_vars.index(v) if v in cur_vars else None, vars.index(v) if v in vars else None)
+                for v in new_vars
+            ])
+            cur_vars = new_vars
+
+        if cur_vars != list(range(self.arity)):
+            cur = _shared(SimpleProjection, cur, [ cur_vars.index(v) for v in range(self.arity) ])
+        return ((1,) * self.arity, cur)
+
+def _enumerated(answers):
+    # the relation answering a masked_filter() call if all its columns are bound
+    if len(answers) == 1 and all(answers[0][0]):
+        return answers[0][1]
+    return None
+
 class Projection(Relation):
     def __init__(self, a, new_axes):
         self.a = a
@@ -398,31 +2125,67 @@ class Projection(Relation):
 
         super().__init__()
 
-    def masked_filter(self, f):
+    def _structure(self):
+        return (Projection, self.a._structure(), tuple(self.new_axes))
+
+    def _masked_filter(self, f):
+        # demand is given in our columns, translate it to the columns of `a`
+        # (columns we drop stay unbound, their values are ignored)
+        a_f = []
+        for mask, f_masked in f:
+            a_mask = []
+            a_axes = []
+            for j in range(self.a.arity):
+                i = self.new_axes.index(j) if j in self.new_axes else None
+                if i is not None and mask[i]:
+                    a_mask.append(1)
+                    a_axes.append(i)
+                else:
+                    a_mask.append(0)
+                    a_axes.append(0)
+            a_f.append((tuple(a_mask), _shared(SimpleProjection, f_masked, a_axes)))
+
         return masked_projection(
-            self.a.masked_filter(f), self.new_axes)
+            self.a.masked_filter(reduce_masked(a_f)), self.new_axes)
 
 class ExternalFunction(Relation):
-    def __init__(self, func, f_arity):
+    def __init__(self, func, f_arity, *, cache=None, vectorized=False,
+                 policy='inline', max_workers=None):
         self.func = func
         self.f_arity = f_arity
         self.arity = f_arity + 1
+        # optional FunctionCache shared by every SimpleExternalFunction built here
+        self.cache = cache
+        # if set, func is called once per sync round with argument columns
+        self.vectorized = vectorized
+        # how pending calls of a sync round are run, see EXECUTION_POLICIES
+        if policy not in EXECUTION_POLICIES:
+            raise ValueError('unknown execution policy %r' % policy)
+        self.policy = policy
+        self.max_workers = max_workers
 
         super().__init__()
 
-    def masked_filter(self, f):
+    def _structure(self):
+        return (ExternalFunction, self.func, self.f_arity, self.cache, self.vectorized,
+                self.policy, self.max_workers)
+
+    def _masked_filter(self, f):
         result = []
 
         for mask, f_masked in f:
             assert len(mask) == self.arity
 
             if not all(mask[:self.f_arity]):
-                result.append(((0,) * self.arity, DataRelation(arity=self.arity)))
+                result.append(((0,) * self.arity, DataRelation(arity=self.arity, scheduler=f_masked._scheduler)))
             else:
                 has_value = mask[-1] == 1
-                result.append(((1,) * self.arity, SimpleExternalFunction(
+                result.append(((1,) * self.arity, _shared(
+                    SimpleExternalFunction,
                     a=f_masked, f=self.func,
-                    f_arity=self.f_arity, has_value=has_value)))
+                    f_arity=self.f_arity, has_value=has_value,
+                    cache=self.cache, vectorized=self.vectorized,
+                    policy=self.policy, max_workers=self.max_workers)))
 
         return reduce_masked(result)
 
@@ -433,17 +2196,15 @@ class SimpleEq(SimpleRelation):
         super().__init__()
 
     def _enable(self):
-        self.a._add_callbacks.append(self.__added)
-        self.a._remove_callbacks.append(self.__removed)
-        self.a.run_for_all(self.__added)
-
-    def __added(self, t):
-        if t[0] == t[1]:
-            self._self_add(t)
+        self.a._subscribe(self.__changed)
 
-    def __removed(self, t):
-        if t[0] == t[1]:
-            self._self_remove(t)
+    def __changed(self, added, removed):
+        for t in removed:
+            if t[0] == t[1]:
+                self._self_remove(t)
+        for t in added:
+            if t[0] == t[1]:
+                self._self_add(t)
 
 class Eq(Relation):
     def __init__(self):
@@ -451,13 +2212,16 @@ class Eq(Relation):
 
         super().__init__()
 
-    def masked_filter(self, f):
+    def _structure(self):
+        return (Eq,)
+
+    def _masked_filter(self, f):
         result = []
 
         for mask, f_masked in f:
             if mask == (0, 0):
                 # is this correct?
-                result.append(((0, 0), DataRelation(arity=2)))
+                result.append(((0, 0), DataRelation(arity=2, scheduler=f_masked._scheduler)))
             elif mask == (1, 0):
                 result.append(((1, 1), SimpleProjection(f_masked, (0, 0))))
             elif mask == (0, 1):
@@ -0,0 +1,220 @@
+import mmap, os, pickle, struct, zlib
+
+# Snapshot file layout (little endian):
+#   header: magic, format version, number of sections
+#   table: (offset, length) of each section
+#   sections: pickled blobs - a manifest with the class and arity of every
+#             node, then one section per node holding (tuples, state)
+# Sections are located through the table, so a reader can mmap the file
+# and unpickle only what it needs.
+_MAGIC = b'DLOGSNAP'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+_ENTRY = struct.Struct('<QQ')
+
+def _graph_nodes(roots):
+    # operators the roots depend on, inputs before their consumers, in an
+    # order that only depends on how the graph was built
+    order = []
+    seen = set()
+    for name in sorted(roots):
+        stack = [(roots[name], False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+            elif node not in seen:
+                seen.add(node)
+                stack.append((node, True))
+                stack.extend( (i, False) for i in reversed(node._inputs()) )
+    return order
+
+def save_snapshot(path, roots):
+    '''
+    Saves the contents of the graph under `roots` (a dict of name ->
+    relation): base tuples, materialized operator contents and operator
+    state such as union counts or external function values. Call sync()
+    first. The file is replaced atomically.
+    '''
+    nodes = _graph_nodes(roots)
+    if any( node._added or node._removed or node._rederive for node in nodes ):
+        raise ValueError('graph has changes not propagated yet, call sync() first')
+
+    sections = [ pickle.dumps([ (type(node).__name__, node.arity) for node in nodes ], pickle.HIGHEST_PROTOCOL) ]
+    for node in nodes:
+        sections.append(pickle.dumps((list(node._tuples), node._state()), pickle.HIGHEST_PROTOCOL))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(sections)))
+        offset = _HEADER.size + _ENTRY.size * len(sections)
+        for section in sections:
+            f.write(_ENTRY.pack(offset, len(section)))
+            offset += len(section)
+        for section in sections:
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_snapshot(path, roots):
+    '''
+    Loads a snapshot saved by save_snapshot into a graph built the same way
+    (usually freshly, with empty base relations). No deltas are delivered -
+    the operators are warm and only process changes made afterwards.
+    '''
+    nodes = _graph_nodes(roots)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise ValueError('%s is not a dlog snapshot' % path)
+
+        def section(i):
+            offset, length = _ENTRY.unpack_from(data, _HEADER.size + i * _ENTRY.size)
+            return pickle.loads(data[offset:offset + length])
+
+        manifest = section(0)
+        if manifest != [ (type(node).__name__, node.arity) for node in nodes ]:
+            raise ValueError('%s was saved from a different graph' % path)
+
+        for i, node in enumerate(nodes):
+            tuples, state = section(i + 1)
+            node._load(tuples, state)
+
+# Log segments are files of records, each one batch of changes committed by
+# one sync(): length and crc32 of the payload, then the pickled payload,
+# a list of (relation name, added, removed) in the order they were delivered.
+_RECORD = struct.Struct('<II')
+_SNAPSHOT_NAME = 'snapshot.bin'
+
+def _segments(directory):
+    return sorted( name for name in os.listdir(directory) if name.endswith('.wal') )
+
+class DeltaLog:
+    '''
+    Append-only log of the changes to the named DataRelations in
+    `relations`, as committed by sync(). The changes of each sync() are
+    written as one record; with fsync=True the record is on disk before
+    sync() returns. A new segment is started whenever the current one
+    exceeds `segment_size` bytes.
+
+    checkpoint(roots) compacts the log: it saves a snapshot of the graph
+    and deletes the segments it covers. recover() loads that snapshot and
+    replays the rest.
+    '''
+
+    def __init__(self, directory, relations, *, fsync=True, segment_size=64 << 20):
+        self.directory = directory
+        self.relations = relations
+        self.fsync = fsync
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        segments = _segments(directory)
+        self._next_segment = int(segments[-1][:-len('.wal')]) + 1 if segments else 0
+        self._file = None
+        self._open_segment()
+
+        self._batch = []
+        self._attaching = True
+        for name, rel in relations.items():
+            rel._subscribe(self.__record, name)
+        self._attaching = False
+
+        self._schedulers = []
+        for rel in relations.values():
+            if not any( rel._scheduler is s for s in self._schedulers ):
+                self._schedulers.append(rel._scheduler)
+                rel._scheduler._sync_hooks.append(self._write_batch)
+
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, '%08d.wal' % self._next_segment)
+        self._next_segment += 1
+        self._file = open(path, 'ab')
+
+    def __record(self, name, added, removed):
+        # the current contents are delivered on subscribing, they are
+        # already in the snapshot or earlier segments
+        if not self._attaching:
+            self._batch.append((name, list(added), list(removed)))
+
+    def _write_batch(self):
+        if not self._batch:
+            return
+        payload = pickle.dumps(self._batch, pickle.HIGHEST_PROTOCOL)
+        self._batch = []
+
+        self._file.write(_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if self._file.tell() >= self.segment_size:
+            self._open_segment()
+
+    def checkpoint(self, roots):
+        '''
+        Saves a snapshot of the graph under `roots` (which has to include
+        the logged relations, after sync()) and deletes the segments it
+        covers.
+        '''
+        self._write_batch()
+        self._open_segment()
+        current = os.path.basename(self._file.name)
+        save_snapshot(os.path.join(self.directory, _SNAPSHOT_NAME), roots)
+        # replaying a segment over a snapshot that already contains it is
+        # harmless, so crashing before the deletion loses nothing
+        for name in _segments(self.directory):
+            if name < current:
+                os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        self._write_batch()
+        for scheduler in self._schedulers:
+            scheduler._sync_hooks.remove(self._write_batch)
+        self._schedulers = []
+        for rel in self.relations.values():
+            rel._unsubscribe(self)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def replay(directory, relations):
+    '''
+    Pushes the changes recorded in the log segments of `directory` into
+    the named DataRelations, in order; call sync() afterwards. A segment
+    ends at its first incomplete or damaged record - what a crash while
+    writing leaves behind.
+    '''
+    for name in _segments(directory):
+        with open(os.path.join(directory, name), 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        while offset + _RECORD.size <= len(data):
+            length, crc = _RECORD.unpack_from(data, offset)
+            payload = data[offset + _RECORD.size:offset + _RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            for rel_name, added, removed in pickle.loads(payload):
+                relations[rel_name].update(added=added, removed=removed)
+            offset += _RECORD.size + length
+
+def recover(directory, roots, relations):
+    '''
+    Restores a graph built the same way as the logged one: loads the last
+    checkpoint of `directory` (if any) into `roots` and replays the newer
+    log segments into `relations`.
+    '''
+    snapshot_path = os.path.join(directory, _SNAPSHOT_NAME)
+    if os.path.exists(snapshot_path):
+        load_snapshot(snapshot_path, roots)
+    if os.path.isdir(directory):
+        replay(directory, relations)
+    for rel in relations.values():
+        rel._scheduler.sync()
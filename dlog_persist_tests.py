@@ -0,0 +1,130 @@
+import os, shutil, tempfile, unittest
+import dlog, dlog_persist
+
+def build(storage=None):
+    edges = dlog.DataRelation(arity=2, storage=storage)
+    closure = dlog.SimpleLink(arity=2)
+    step = dlog.SimpleProjection(dlog.SimpleJoin(
+        closure, dlog.SimpleProjection(edges, (1, 0)), join_k=1), (2, 1))
+    closure.link(dlog.SimpleUnion([ step, edges ]))
+    return edges, closure
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_closure(self):
+        edges, closure = build()
+        edges.add_many([ (1, 2), (2, 3), (3, 1), (4, 5) ])
+        dlog.sync()
+        dlog_persist.save_snapshot(self.path, { 'closure': closure })
+
+        edges2, closure2 = build(storage=dlog.ColumnarTupleStore)
+        dlog.sync()
+        dlog_persist.load_snapshot(self.path, { 'closure': closure2 })
+        self.assertEqual(edges2.to_set(), edges.to_set())
+        self.assertEqual(closure2.to_set(), closure.to_set())
+
+        # views are warm: only the new delta is processed
+        derived = closure2.stats.derived
+        edges2.add((5, 1))
+        dlog.sync()
+        new_paths = { (5, 1), (5, 2), (5, 3), (4, 1), (4, 2), (4, 3) }
+        self.assertEqual(closure2.stats.derived - derived, len(new_paths))
+        self.assertEqual(closure2.to_set(), closure.to_set() | new_paths)
+
+        # removals after a reload still rederive correctly
+        edges2.remove((3, 1))
+        dlog.sync()
+        self.assertEqual(closure2.to_set(), { (1, 2), (1, 3), (2, 3), (4, 5) } | new_paths)
+
+    def test_external_function(self):
+        calls = []
+        def f(x):
+            calls.append(x)
+            return x * 2
+
+        def build_ext():
+            foo = dlog.DataRelation(arity=1)
+            return foo, dlog.SimpleExternalFunction(a=foo, f=f, f_arity=1, has_value=False)
+
+        foo, doubled = build_ext()
+        foo.add_many([ (1,), (2,) ])
+        dlog.sync()
+        dlog_persist.save_snapshot(self.path, { 'doubled': doubled })
+
+        foo2, doubled2 = build_ext()
+        dlog_persist.load_snapshot(self.path, { 'doubled': doubled2 })
+        del calls[:]
+        foo2.add((3,))
+        foo2.remove((1,))
+        dlog.sync()
+        self.assertEqual(calls, [3])
+        self.assertEqual(doubled2.to_set(), { (2, 4), (3, 6) })
+
+    def test_different_graph(self):
+        edges, closure = build()
+        dlog.sync()
+        dlog_persist.save_snapshot(self.path, { 'closure': closure })
+        with self.assertRaises(ValueError):
+            dlog_persist.load_snapshot(self.path, { 'edges': edges })
+
+class DeltaLogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        edges, closure = build()
+        with dlog_persist.DeltaLog(self.directory, { 'edges': edges }, segment_size=100) as log:
+            edges.add_many([ (1, 2), (2, 3) ])
+            dlog.sync()
+            edges.remove((1, 2))
+            edges.add((3, 4))
+            dlog.sync()
+            dlog.sync()
+        self.assertGreater(len(os.listdir(self.directory)), 1)
+
+        edges2, closure2 = build()
+        dlog_persist.recover(self.directory, { 'closure': closure2 }, { 'edges': edges2 })
+        self.assertEqual(edges2.to_set(), { (2, 3), (3, 4) })
+        self.assertEqual(closure2.to_set(), closure.to_set())
+
+    def test_checkpoint(self):
+        edges, closure = build()
+        log = dlog_persist.DeltaLog(self.directory, { 'edges': edges })
+        edges.add_many([ (1, 2), (2, 3) ])
+        dlog.sync()
+        log.checkpoint({ 'closure': closure })
+        self.assertEqual(sorted(os.listdir(self.directory)), [ '00000001.wal', 'snapshot.bin' ])
+
+        edges.add((3, 1))
+        edges.remove((1, 2))
+        dlog.sync()
+        log.close()
+
+        # a crash in the middle of writing a record
+        with open(os.path.join(self.directory, '00000001.wal'), 'ab') as f:
+            f.write(b'\x10\x00\x00\x00garbage')
+
+        edges2, closure2 = build()
+        dlog_persist.recover(self.directory, { 'closure': closure2 }, { 'edges': edges2 })
+        self.assertEqual(edges2.to_set(), { (2, 3), (3, 1) })
+        self.assertEqual(closure2.to_set(), closure.to_set())
+
+        # logging continues in a new segment
+        with dlog_persist.DeltaLog(self.directory, { 'edges': edges2 }):
+            edges2.add((5, 6))
+            dlog.sync()
+        edges3, closure3 = build()
+        dlog_persist.recover(self.directory, { 'closure': closure3 }, { 'edges': edges3 })
+        self.assertEqual(edges3.to_set(), { (2, 3), (3, 1), (5, 6) })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+import collections, multiprocessing, os, pickle, traceback, zlib
+import dlog
+
+def shard_of(value, n_shards):
+    # stable across processes, unlike hash() of strings
+    return zlib.crc32(repr(value).encode('utf8')) % n_shards
+
+def _partition(added, removed, key, n_shards):
+    # shard -> (added, removed) with the tuples whose `key` column hashes there
+    batches = collections.defaultdict(lambda: (set(), set()))
+    for t in added:
+        batches[shard_of(t[key], n_shards)][0].add(t)
+    for t in removed:
+        batches[shard_of(t[key], n_shards)][1].add(t)
+    return batches
+
+class Exchange(dlog.SimpleRelation):
+    '''
+    Receiving end of a repartitioning: holds the tuples that any worker
+    sent to this shard. A tuple may be sent by several workers, so copies
+    are counted. Inside a cycle, the remaining copies of a removed tuple may
+    depend on the tuple itself, so it is over-deleted and rederived if any
+    copy survives the removals.
+    '''
+
+    def __init__(self, arity, *, scheduler=None):
+        self.arity = arity
+        self.counts = collections.Counter()
+        super().__init__(scheduler=scheduler)
+
+    def _receive(self, added, removed):
+        counts = self.counts
+        out_removed = set()
+        over_deleted = set()
+        for t in removed:
+            counts[t] -= 1
+            if counts[t] == 0:
+                del counts[t]
+                out_removed.add(t)
+            elif self._recursive:
+                over_deleted.add(t)
+
+        out_added = set()
+        for t in added:
+            counts[t] += 1
+            if counts[t] == 1:
+                out_added.add(t)
+
+        self._self_apply(out_added, out_removed | over_deleted)
+        self._over_delete(over_deleted - self._tuples)
+
+    def _rederivable(self, t):
+        return self.counts.get(t, 0) > 0
+
+class ShardContext:
+    '''
+    Passed to the build function in every worker. The function builds the
+    same graph on each shard, using input() for partitioned base relations
+    and exchange() wherever a relation has to be repartitioned on another
+    column (e.g. before a join on that column).
+    '''
+
+    def __init__(self, shard, n_shards):
+        self.shard = shard
+        self.n_shards = n_shards
+        self.scheduler = dlog.Scheduler()
+        # name -> (relation, key column)
+        self.inputs = {}
+        # (exchange, source relation)
+        self.exchanges = []
+        self.outputs = {}
+        # shard -> messages for the next round
+        self._outbox = collections.defaultdict(list)
+
+    def input(self, name, arity, key=0):
+        rel = dlog.DataRelation(arity, scheduler=self.scheduler)
+        self.inputs[name] = (rel, key)
+        return rel
+
+    def exchange(self, rel, key=0):
+        '''Repartitions `rel` so that each shard holds the tuples whose `key` column hashes to it.'''
+        ex = Exchange(rel.arity, scheduler=self.scheduler)
+        rel._subscribe(self.__send, len(self.exchanges), key)
+        self.exchanges.append((ex, rel))
+        return ex
+
+    def output(self, name, rel):
+        self.outputs[name] = rel
+
+    def __send(self, exchange_id, key, added, removed):
+        for shard, (b_added, b_removed) in _partition(added, removed, key, self.n_shards).items():
+            self._outbox[shard].append(('exchange', exchange_id, b_added, b_removed))
+
+    def _finish(self):
+        # an exchange whose source depends on the exchange itself closes a
+        # cycle through the other workers - treat it like a SimpleLink cycle
+        # so that deletions use Delete-and-Rederive
+        for ex, rel in self.exchanges:
+            for node in dlog._nodes_between(ex, rel):
+                node._recursive = True
+        self.scheduler._rerank()
+
+    def _step(self, phase, inbox):
+        for kind, name, added, removed in inbox:
+            if kind == 'input':
+                self.inputs[name][0].update(added=added, removed=removed)
+            else:
+                self.exchanges[name][0]._receive(added, removed)
+
+        if phase == 'delete':
+            self.scheduler._propagate_removals()
+        else:
+            self.scheduler._propagate_additions()
+
+        outbox = dict(self._outbox)
+        self._outbox.clear()
+        return outbox
+
+def _worker_main(conn, build, shard, n_shards):
+    # replies are ('ok', value) or ('error', exception)
+    try:
+        ctx = ShardContext(shard, n_shards)
+        build(ctx)
+        ctx._finish()
+        conn.send(('ok', { name: key for name, (rel, key) in ctx.inputs.items() }))
+
+        while True:
+            msg = conn.recv()
+            if msg[0] == 'step':
+                conn.send(('ok', ctx._step(msg[1], msg[2])))
+            elif msg[0] == 'read':
+                conn.send(('ok', set(ctx.outputs[msg[1]]._tuples)))
+            elif msg[0] == 'stop':
+                break
+    except Exception as exc:
+        try:
+            pickle.dumps(exc)
+        except Exception:
+            exc = RuntimeError('shard %d failed:\n%s' % (shard, ''.join(traceback.format_exception(exc))))
+        conn.send(('error', exc))
+
+class ShardedGraph:
+    '''
+    Runs a dataflow graph on `n_shards` worker processes. `build(ctx)` is
+    called in every worker with a ShardContext and must be picklable (a
+    module level function). Base relations are hash-partitioned on their
+    key column; updates go through add()/remove()/update() and are applied
+    by sync().
+
+    sync() runs in bulk synchronous rounds: every worker applies the
+    messages addressed to it, propagates locally and returns the deltas it
+    sends to other shards, which the driver routes to them for the next
+    round. Removals are propagated to a global fixpoint before any
+    additions, like Scheduler.sync() does locally.
+
+    An exception raised in a worker (by build() or while propagating) is
+    re-raised by the driver call that was waiting for it, after all
+    workers have been stopped.
+    '''
+
+    def __init__(self, build, n_shards=None, *, start_method=None):
+        self.n_shards = n_shards or os.cpu_count()
+        mp = multiprocessing.get_context(start_method)
+        self._conns = []
+        self._processes = []
+        for shard in range(self.n_shards):
+            conn, child_conn = mp.Pipe()
+            process = mp.Process(target=_worker_main, args=(child_conn, build, shard, self.n_shards), daemon=True)
+            process.start()
+            self._conns.append(conn)
+            self._processes.append(process)
+
+        # input name -> key column
+        self._keys = [ self.__receive(conn) for conn in self._conns ][0]
+        self._staged = {}
+
+    def update(self, name, added=(), removed=()):
+        staged_added, staged_removed = self._staged.setdefault(name, (set(), set()))
+        for t in removed:
+            staged_added.discard(t)
+            staged_removed.add(t)
+        for t in added:
+            staged_removed.discard(t)
+            staged_added.add(t)
+
+    def add(self, name, t):
+        self.update(name, added=[t])
+
+    def remove(self, name, t):
+        self.update(name, removed=[t])
+
+    def sync(self):
+        inbox = [ [] for shard in range(self.n_shards) ]
+        for name, (added, removed) in self._staged.items():
+            batches = _partition(added, removed, self._keys[name], self.n_shards)
+            for shard, (b_added, b_removed) in batches.items():
+                inbox[shard].append(('input', name, b_added, b_removed))
+        self._staged = {}
+
+        # additions never cause removals, so one pass of each phase suffices
+        self.__rounds('delete', inbox)
+        self.__rounds('add', [ [] for shard in range(self.n_shards) ])
+
+    def __rounds(self, phase, inbox):
+        # runs rounds until no worker sends anything
+        first = True
+        while first or any(inbox):
+            first = False
+            for conn, messages in zip(self._conns, inbox):
+                conn.send(('step', phase, messages))
+
+            inbox = [ [] for shard in range(self.n_shards) ]
+            for conn in self._conns:
+                for shard, messages in self.__receive(conn).items():
+                    inbox[shard] += messages
+
+    def to_set(self, name):
+        for conn in self._conns:
+            conn.send(('read', name))
+        result = set()
+        for conn in self._conns:
+            result |= self.__receive(conn)
+        return result
+
+    def __receive(self, conn):
+        status, value = conn.recv()
+        if status == 'error':
+            self.close()
+            raise value
+        return value
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(('stop',))
+            except OSError:
+                # the worker already exited after an error
+                pass
+        for process in self._processes:
+            process.join()
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,73 @@
+import random, unittest
+import dlog, dlog_sharded
+
+def build_closure(ctx):
+    edges = ctx.input('edges', 2, key=0)
+    closure = dlog.SimpleLink(arity=2, scheduler=ctx.scheduler)
+    # paths (x, y) go to the shard of y, where the edges (y, z) are
+    by_end = ctx.exchange(dlog.SimpleProjection(closure, (1, 0)), key=0)
+    step = dlog.SimpleProjection(dlog.SimpleJoin(by_end, edges, 1), (1, 2))
+    closure.link(dlog.SimpleUnion([ edges, step ]))
+    ctx.output('closure', closure)
+
+def build_failing(ctx):
+    if ctx.shard == 1:
+        raise KeyError('no shard 1')
+    ctx.output('edges', ctx.input('edges', 2, key=0))
+
+def _check_edge(a, b):
+    if a == b: raise ValueError('loop at %r' % a)
+    return True
+
+def build_checked(ctx):
+    edges = ctx.input('edges', 2, key=0)
+    ctx.output('checked', dlog.SimpleExternalFunction(a=edges, has_value=False, f=_check_edge, f_arity=2))
+
+def expected_closure(edges):
+    result = set(edges)
+    while True:
+        new = result | { (a, d) for a, b in result for c, d in edges if b == c }
+        if new == result: return result
+        result = new
+
+class ShardedTests(unittest.TestCase):
+    def test_shard_of(self):
+        self.assertEqual(dlog_sharded.shard_of('abc', 7), dlog_sharded.shard_of('abc', 7))
+        self.assertEqual({ dlog_sharded.shard_of(i, 3) for i in range(100) }, { 0, 1, 2 })
+
+    def test_closure(self):
+        with dlog_sharded.ShardedGraph(build_closure, 3) as graph:
+            graph.update('edges', added=[ (1, 2), (2, 3), (3, 1), (3, 4) ])
+            graph.sync()
+            self.assertEqual(graph.to_set('closure'), expected_closure({ (1, 2), (2, 3), (3, 1), (3, 4) }))
+
+            # paths through the broken cycle derived each other on different shards
+            graph.remove('edges', (2, 3))
+            graph.sync()
+            self.assertEqual(graph.to_set('closure'), { (1, 2), (3, 1), (3, 4), (3, 2) })
+
+    def test_closure_random_updates(self):
+        rnd = random.Random(5)
+        edges = set()
+        with dlog_sharded.ShardedGraph(build_closure, 4) as graph:
+            for i in range(15):
+                added = { (rnd.randrange(12), rnd.randrange(12)) for _ in range(4) }
+                removed = set(rnd.sample(sorted(edges), min(3, len(edges))))
+                graph.update('edges', added=added, removed=removed)
+                edges = (edges - removed) | added
+                graph.sync()
+                self.assertEqual(graph.to_set('closure'), expected_closure(edges))
+
+    def test_worker_errors(self):
+        with self.assertRaises(KeyError):
+            dlog_sharded.ShardedGraph(build_failing, 3)
+
+        graph = dlog_sharded.ShardedGraph(build_checked, 3)
+        graph.update('edges', added=[ (1, 2), (3, 3) ])
+        with self.assertRaisesRegex(ValueError, 'loop at 3'):
+            graph.sync()
+        # every worker was stopped
+        self.assertEqual(graph._processes, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,4 @@
-import unittest
+import asyncio, gc, operator, random, threading, time, unittest
 import dlog
 
 class SimpleTests(unittest.TestCase):
@@ -31,6 +31,75 @@ class SimpleTests(unittest.TestCase):
         bar.add((3, 103))
         dlog.sync(); self.assertEqual(foo_p.to_set(), { (2, 202, 102), (1, 201, 101), (3, 203, 103) })
 
+    def test_iter_with_prefix(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add((1, 2))
+        foo.add((1, 3))
+        foo.add((2, 3))
+
+        self.assertEqual(set(foo.iter_with_prefix((1,))), { (1, 2), (1, 3) })
+        self.assertEqual(set(foo.iter_with_prefix(())), foo.to_set())
+
+        foo.add((1, 4))
+        foo.remove((1, 2))
+        foo.remove((2, 3))
+        self.assertEqual(set(foo.iter_with_prefix((1,))), { (1, 3), (1, 4) })
+        self.assertEqual(set(foo.iter_with_prefix((2,))), set())
+        self.assertEqual(set(foo.iter_with_prefix((1, 4))), { (1, 4) })
+
+    def test_iter_range(self):
+        foo = dlog.DataRelation(arity=2)
+        for i in range(20):
+            foo.add((i % 5, i))
+
+        self.assertEqual(list(foo.iter()), sorted(foo.to_set()))
+        self.assertEqual(list(foo.iter_range((2,), (3,))), [ (2, 2), (2, 7), (2, 12), (2, 17) ])
+
+        foo.remove((2, 7))
+        foo.add((2, 100))
+        for i in range(20, 40):
+            foo.add((i % 5, i))
+        self.assertEqual(list(foo.iter()), sorted(foo.to_set()))
+        self.assertEqual(list(foo.iter_range((4, 30))), sorted(t for t in foo.to_set() if t >= (4, 30)))
+        self.assertEqual(list(foo.iter_range(None, (0, 10))), [ (0, 0), (0, 5) ])
+
+    def test_batched_delta(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add((0, 0))
+        dlog.sync()
+
+        deltas = []
+        foo._subscribe(lambda added, removed: deltas.append((set(added), set(removed))))
+        self.assertEqual(deltas, [ ({ (0, 0) }, set()) ])
+
+        for i in range(1, 100):
+            foo.add((i, i))
+        foo.remove((0, 0))
+        foo.add((0, 0))
+        foo.remove((1, 1))
+        dlog.sync()
+        self.assertEqual(deltas[1:], [ ({ (i, i) for i in range(2, 100) }, set()) ])
+
+    def test_bulk_update(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (i, i + 1) for i in range(10) ])
+
+        foo_p = dlog.SimpleProjection(foo, (1,))
+        deltas = []
+        foo._subscribe(lambda added, removed: deltas.append((set(added), set(removed))))
+        dlog.sync(); self.assertEqual(foo_p.to_set(), { (i,) for i in range(1, 11) })
+
+        del deltas[:]
+        foo.remove_many([ (0, 1), (1, 2), (100, 101) ])
+        foo.update(added=[ (1, 2), (20, 21), (30, 31) ], removed=[ (2, 3), (30, 31) ])
+        dlog.sync(); self.assertEqual(foo_p.to_set(), { (i,) for i in range(2, 11) } - { (3,) } | { (21,) })
+        # removals are propagated before additions
+        self.assertEqual(deltas, [ (set(), { (0, 1), (2, 3) }), ({ (20, 21) }, set()) ])
+
+        foo.replace_all([ (1, 2), (5, 6), (7, 8) ])
+        dlog.sync(); self.assertEqual(foo_p.to_set(), { (2,), (6,), (8,) })
+        self.assertEqual(foo.to_set(), { (1, 2), (5, 6), (7, 8) })
+
     def test_external_function(self):
         foo = dlog.DataRelation(arity=2)
         foo.add((1, 10, None))
@@ -48,6 +117,21 @@ class SimpleTests(unittest.TestCase):
         res = dlog.SimpleExternalFunction(f=(lambda a, b: a+b), a=foo, has_value=True, f_arity=2)
         dlog.sync(); self.assertEqual(res.to_set(), { (1, 10, 11), (2, 20, 22) })
 
+    def test_function_cache(self):
+        cache = dlog.FunctionCache(capacity=2, policy='lru')
+        calls = []
+        f = lambda a: calls.append(a) or a * 2
+
+        self.assertEqual([ cache.call(f, (x,)) for x in [1, 2, 1, 3, 2, 1] ], [2, 4, 2, 6, 4, 2])
+        self.assertEqual(calls, [1, 2, 3, 2, 1])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 5, 2))
+
+        cache = dlog.FunctionCache(capacity=2, policy='lfu')
+        calls = []
+        self.assertEqual([ cache.call(f, (x,)) for x in [1, 1, 2, 3, 1, 3] ], [2, 2, 4, 6, 2, 6])
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (3, 3, 2))
+
     def test_simple_arbitrary_join(self):
         foo = dlog.DataRelation(arity=2)
         foo.add((1, 101))
@@ -118,6 +202,359 @@ class SimpleTests(unittest.TestCase):
 
         dlog.sync(); self.assertEqual(transitive_closure.to_set(), edges.to_set())
 
+    def _closure(self, edges):
+        transitive_closure = dlog.SimpleLink(arity=2)
+        transitive = dlog.SimpleProjection(dlog.SimpleJoin(
+            transitive_closure, dlog.SimpleProjection(edges, (1, 0)), join_k=1), (2, 1))
+        transitive_closure.link(dlog.SimpleUnion([ transitive, edges ]))
+        return transitive_closure
+
+    def _expected_closure(self, edges):
+        result = set(edges)
+        while True:
+            new = result | { (a, d) for a, b in result for c, d in edges if b == c }
+            if new == result: return result
+            result = new
+
+    def test_closure_remove_cyclic(self):
+        edges = dlog.DataRelation(arity=2)
+        edges.add_many([ (1, 2), (2, 3), (3, 2), (3, 4) ])
+        transitive_closure = self._closure(edges)
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+        # (1, 2) is also derivable as (1, 3) + (3, 2), which in turn needs (1, 2)
+        edges.remove((1, 2))
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+        edges.add((1, 3))
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+        edges.remove_many([ (2, 3), (3, 4) ])
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+        edges.replace_all([ (1, 2), (2, 1), (2, 3) ])
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+        # (2, 3) and (1, 3) support each other through the cycle 1 <-> 2
+        edges.remove((2, 3))
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), { (1, 1), (1, 2), (2, 1), (2, 2) })
+
+    def test_closure_random_updates(self):
+        rnd = random.Random(4)
+        edges = dlog.DataRelation(arity=2)
+        transitive_closure = self._closure(edges)
+
+        for _ in range(30):
+            edges.update(
+                added=[ (rnd.randrange(8), rnd.randrange(8)) for _ in range(3) ],
+                removed=rnd.sample(sorted(edges.to_set()), min(2, len(edges.to_set()))))
+            dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+    def test_closure_columnar(self):
+        storage = dlog.ColumnarTupleStore
+        edges = dlog.DataRelation(arity=2, storage=storage)
+        edges.add_many([ (1, 'a'), ('a', 2), (2, 3), (3, 1), (4, None) ])
+
+        transitive_closure = dlog.SimpleLink(arity=2, storage=storage)
+        transitive = dlog.SimpleProjection(dlog.SimpleJoin(
+            transitive_closure, dlog.SimpleProjection(edges, (1, 0), storage=storage), join_k=1, storage=storage),
+            (2, 1), storage=storage)
+        transitive_closure.link(dlog.SimpleUnion([ transitive, edges ], storage=storage))
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+
+        edges.remove((2, 3))
+        edges.add((None, 1))
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), self._expected_closure(edges.to_set()))
+        self.assertIsInstance(transitive_closure._tuples, dlog.ColumnarTupleStore)
+
+    def test_columnar_store(self):
+        rnd = random.Random(1)
+        store = dlog.ColumnarTupleStore(3)
+        expected = set()
+        for i in range(3000):
+            t = (rnd.randrange(50), rnd.choice([ 'a', 'b', None, True, 1 ]), rnd.randrange(-2**70, 2**70))
+            if i % 3 == 0 and expected:
+                t = rnd.choice(sorted(expected, key=repr))
+            if i % 2:
+                store.discard(t); expected.discard(t)
+            else:
+                store.add(t); expected.add(t)
+
+        self.assertEqual(len(store), len(expected))
+        self.assertEqual(set(store), expected)
+        self.assertTrue(all( t in store for t in expected ))
+        self.assertNotIn((1, 2), store)
+        self.assertEqual({ (0, 'a', 0) } - store, { (0, 'a', 0) })
+
+    def test_multi_join_triangles(self):
+        rnd = random.Random(2)
+        edges = dlog.DataRelation(arity=2)
+        labels = dlog.DataRelation(arity=2)
+        # edges(x, y), edges(y, z), edges(x, z), labels(z, l)
+        triangles = dlog.SimpleMultiJoin([
+            (edges, (0, 1)), (edges, (1, 2)), (edges, (0, 2)), (labels, (2, 3)),
+        ], 4)
+
+        def expected():
+            e = edges.to_set()
+            return { (x, y, z, l) for x, y in e for y1, z in e if y == y1 and (x, z) in e
+                     for z1, l in labels.to_set() if z1 == z }
+
+        for _ in range(30):
+            edges.update(
+                added=[ (rnd.randrange(6), rnd.randrange(6)) for _ in range(4) ],
+                removed=rnd.sample(sorted(edges.to_set()), min(2, len(edges.to_set()))))
+            labels.update(added=[ (rnd.randrange(6), rnd.choice('ab')) ], removed=[ (rnd.randrange(6), 'a') ])
+            dlog.sync(); self.assertEqual(triangles.to_set(), expected())
+
+    def test_multi_join_repeated_var(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 1), (1, 2), (2, 2) ])
+        bar = dlog.DataRelation(arity=1)
+        bar.add_many([ (1,), (3,) ])
+
+        loops = dlog.SimpleMultiJoin([ (foo, (0, 0)), (bar, (0,)) ], 1)
+        dlog.sync(); self.assertEqual(loops.to_set(), { (1,) })
+        bar.add((2,))
+        foo.remove((1, 1))
+        dlog.sync(); self.assertEqual(loops.to_set(), { (2,) })
+
+        # (1, 2) never matched, removing it keeps (1,)
+        foo.add((1, 1))
+        dlog.sync(); self.assertEqual(loops.to_set(), { (1,), (2,) })
+        foo.remove((1, 2))
+        dlog.sync(); self.assertEqual(loops.to_set(), { (1,), (2,) })
+
+    def test_statistics(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 1), (1, 2), (2, 2) ])
+        self.assertEqual(foo.statistics(), dlog.RelationStats(count=3, distinct=(2, 2)))
+        self.assertEqual(dlog.NotSimple(foo).statistics(), foo.statistics())
+        # no index is kept around just for the statistics
+        self.assertEqual(foo._indexes, {})
+
+        foo.remove((1, 1))
+        foo.remove((1, 2))
+        self.assertEqual(foo.statistics(), dlog.RelationStats(count=1, distinct=(1, 1)))
+
+    def test_operator_gc(self):
+        gc.collect()
+        before = dlog.live_operators()
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3) ])
+        proj = dlog.SimpleProjection(foo, (1, 0))
+        joined = dlog.SimpleJoin(proj, foo, 1)
+        dlog.sync()
+        self.assertEqual(joined.to_set(), { (2, 1, 3) })
+        self.assertEqual(dlog.live_operators(), before + 3)
+
+        # dropped operators are detached from their inputs
+        del joined, proj
+        gc.collect()
+        self.assertEqual(dlog.live_operators(), before + 1)
+        foo.add((5, 6))
+        dlog.sync()
+        self.assertEqual(foo._delta_callbacks, [])
+
+        with dlog.SimpleProjection(foo, (0,)) as firsts:
+            dlog.sync(); self.assertEqual(firsts.to_set(), { (1,), (2,), (5,) })
+        self.assertEqual(foo._delta_callbacks, [])
+        foo.add((7, 8))
+        dlog.sync(); self.assertEqual(firsts.to_set(), set())
+
+    def test_topological_order(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add((1, 'x'))
+        short = dlog.SimpleProjection(foo, (0, 1))
+        long = dlog.SimpleProjection(dlog.SimpleProjection(dlog.SimpleProjection(foo, (0, 1)), (0, 1)), (0, 1))
+        joined = dlog.SimpleJoin(short, long, 1)
+        dlog.sync()
+
+        deltas = []
+        joined._subscribe(lambda added, removed: deltas.append((set(added), set(removed))))
+        deltas.clear()
+        foo.add((1, 'y'))
+        dlog.sync()
+        # the join runs once, after both of its inputs have settled
+        self.assertEqual(deltas, [ ({ (1, 'y', 'x'), (1, 'x', 'y'), (1, 'y', 'y') }, set()) ])
+
+    def test_independent_graphs(self):
+        graph = dlog.Scheduler()
+        foo = dlog.DataRelation(arity=2, scheduler=graph)
+        foo_p = dlog.SimpleProjection(foo, (1, 0))
+        foo.add((1, 2))
+
+        dlog.sync(); self.assertEqual(foo_p.to_set(), set())
+        graph.sync(); self.assertEqual(foo_p.to_set(), { (2, 1) })
+
+        bar = dlog.DataRelation(arity=2)
+        with self.assertRaises(ValueError):
+            dlog.SimpleJoin(foo, bar, 1)
+
+    def test_transactions(self):
+        graph = dlog.Scheduler()
+        foo = dlog.DataRelation(arity=2, scheduler=graph)
+        foo_p = dlog.SimpleProjection(foo, (1, 0))
+
+        with graph.transaction() as txn:
+            txn.add(foo, (1, 2))
+            txn.add(foo, (3, 4))
+            txn.remove(foo, (3, 4))
+        self.assertEqual(graph.version, 1)
+        with graph.snapshot() as snap:
+            self.assertEqual(snap.to_set(foo_p), { (2, 1) })
+
+        stop = threading.Event()
+        errors = []
+
+        def writer(base):
+            for i in range(100):
+                with graph.transaction() as txn:
+                    txn.add(foo, (base + i, 'a'))
+                    txn.add(foo, (base + i, 'b'))
+
+        def reader():
+            while not stop.is_set():
+                with graph.snapshot() as snap:
+                    tuples = snap.to_set(foo)
+                    # give a commit the chance to run in between
+                    time.sleep(0.001)
+                    swapped = snap.to_set(foo_p)
+                    if len(tuples) % 2 != 1 or swapped != { (b, a) for a, b in tuples }:
+                        errors.append((snap.version, tuples, swapped))
+
+        readers = [ threading.Thread(target=reader) for i in range(2) ]
+        writers = [ threading.Thread(target=writer, args=(base,)) for base in (1000, 2000) ]
+        for t in readers + writers: t.start()
+        for t in writers: t.join()
+        stop.set()
+        for t in readers: t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(graph.version, 201)
+        self.assertEqual(len(foo_p.to_set()), 401)
+
+    def test_transaction_undo(self):
+        graph = dlog.Scheduler()
+        foo = dlog.DataRelation(arity=1, scheduler=graph)
+        foo.update(added=[ (i,) for i in range(1000) ])
+        graph.sync()
+
+        seen = []
+        def f(x):
+            # while the commit propagates, only its own changes are kept
+            seen.append(foo._undo)
+            with graph.snapshot() as snap:
+                seen.append(len(snap.to_set(foo)))
+            return x
+        foo_f = dlog.SimpleExternalFunction(a=foo, has_value=False, f=f, f_arity=1)
+        seen.clear()
+
+        with graph.transaction() as txn:
+            txn.add(foo, (-1,))
+            txn.remove(foo, (0,))
+        self.assertEqual(seen, [ ({ (-1,) }, { (0,) }), 1000 ])
+        self.assertIsNone(foo._undo)
+        self.assertEqual(len(foo_f.to_set()), 1000)
+
+    def test_transaction_failure(self):
+        graph = dlog.Scheduler()
+        foo = dlog.DataRelation(arity=1, scheduler=graph)
+        foo_p = dlog.SimpleProjection(foo, (0, 0))
+
+        def f(x):
+            if x == 3: raise ZeroDivisionError()
+            return x
+        foo_f = dlog.SimpleExternalFunction(a=foo, has_value=False, f=f, f_arity=1)
+
+        with graph.transaction() as txn:
+            txn.add(foo, (1,))
+        with self.assertRaises(ZeroDivisionError):
+            with graph.transaction() as txn:
+                txn.add(foo, (2,))
+                txn.add(foo, (3,))
+
+        # nothing of the failed commit is published
+        self.assertEqual(graph.version, 1)
+        with graph.snapshot() as snap:
+            self.assertEqual(snap.version, 1)
+            self.assertEqual(snap.to_set(foo), { (1,) })
+            self.assertEqual(snap.to_set(foo_p), { (1, 1) })
+            self.assertEqual(snap.to_set(foo_f), { (1, 1) })
+
+        with self.assertRaises(RuntimeError):
+            with graph.transaction() as txn:
+                txn.add(foo, (4,))
+        self.assertEqual(graph.version, 1)
+
+    def test_projection_remove(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (1, 3), (2, 3) ])
+
+        foo_p = dlog.SimpleProjection(foo, (0,))
+        dlog.sync(); self.assertEqual(foo_p.to_set(), { (1,), (2,) })
+
+        foo.remove((1, 2))
+        dlog.sync(); self.assertEqual(foo_p.to_set(), { (1,), (2,) })
+
+        foo.remove((1, 3))
+        dlog.sync(); self.assertEqual(foo_p.to_set(), { (2,) })
+
+    def test_projection_counts(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (1, 3), (1, 4), (2, 3) ])
+        foo_p = dlog.SimpleProjection(foo, (0,))
+        dlog.sync()
+        # only outputs with more than one source tuple are counted explicitly
+        self.assertEqual(foo_p.counts, { (1,): 3 })
+
+        deltas = []
+        foo_p._subscribe(lambda added, removed: deltas.append((set(added), set(removed))))
+        deltas.clear()
+        foo.remove_many([ (1, 2), (2, 3) ])
+        foo.add((3, 3))
+        dlog.sync()
+        self.assertEqual(deltas, [ (set(), { (2,) }), ({ (3,) }, set()) ])
+        self.assertEqual(foo_p.counts, { (1,): 2 })
+
+        foo.remove_many([ (1, 3), (1, 4) ])
+        dlog.sync()
+        self.assertEqual(deltas[-1], (set(), { (1,) }))
+        self.assertEqual(foo_p.counts, {})
+
+    def test_arbitrary_join(self):
+        rnd = random.Random(7)
+        foo = dlog.DataRelation(arity=2)
+        bar = dlog.DataRelation(arity=3)
+        axes = [ (1, 0), (None, 2), (0, None) ]
+        join = dlog.SimpleArbitraryJoin(foo, bar, axes)
+        self_join = dlog.SimpleArbitraryJoin(foo, foo, [ (1, 0), (0, None) ])
+
+        for step in range(30):
+            for rel in (foo, bar):
+                rel.add_many([ tuple( rnd.randrange(4) for i in range(rel.arity) ) for i in range(5) ])
+                rel.remove_many(rnd.sample(sorted(rel._tuples), min(3, len(rel._tuples))))
+            dlog.sync()
+
+            self.assertEqual(join.to_set(), { (b, c, a) for a, b in foo.to_set() for b1, x, c in bar.to_set() if b == b1 })
+            self.assertEqual(self_join.to_set(), { (b, a) for a, b in foo.to_set() for b1, x in foo.to_set() if b == b1 })
+
+    def test_closure_stats(self):
+        edges = dlog.DataRelation(arity=2)
+        edges.add_many([ (i, i + 1) for i in range(10) ])
+
+        transitive_closure = dlog.SimpleLink(arity=2)
+        transitive = dlog.SimpleProjection(dlog.SimpleJoin(
+            transitive_closure, dlog.SimpleProjection(edges, (1, 0)), join_k=1), (2, 1))
+        transitive_closure.link(dlog.SimpleUnion([ transitive, edges ]))
+
+        dlog.sync(); self.assertEqual(transitive_closure.to_set(), { (i, j) for i in range(11) for j in range(i + 1, 11) })
+        self.assertEqual(transitive_closure.stats, dlog.FixpointStats(iterations=10, derived=55))
+
+        edges.add((10, 11))
+        dlog.sync(); self.assertEqual(len(transitive_closure.to_set()), 66)
+        self.assertEqual(transitive_closure.stats, dlog.FixpointStats(iterations=21, derived=66))
+
 class OnDemandTests(unittest.TestCase):
     def test_join_data(self):
         foo = dlog.DataRelation(arity=2)
@@ -143,6 +580,200 @@ class OnDemandTests(unittest.TestCase):
         bar.add((3, 103))
         dlog.sync(); self.assertEqual(foo_s.to_set(), { (2, 202, 102), (1, 201, 101), (3, 203, 103), (3, 203, 302) })
 
+    def test_projection_filter(self):
+        foo = dlog.DataRelation(arity=3)
+        foo.add_many([ (1, 2, 3), (2, 1, 4), (1, 3, 5) ])
+
+        swapped = dlog.Projection(dlog.NotSimple(foo), [1, 0])
+        res = swapped.filter([ ((1, 0), dlog.single((1, None))) ])
+        dlog.sync(); self.assertEqual(res.to_set(), { (1, 2) })
+
+    def test_shared_nodes(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3) ])
+        bar = dlog.DataRelation(arity=2)
+        bar.add_many([ (2, 5), (3, 6) ])
+
+        joined = dlog.Join(dlog.NotSimple(foo), dlog.NotSimple(bar), 1)
+        demand = [ ((0, 0, 0), dlog.single((None, None, None))) ]
+        res1 = joined.filter(demand)
+        res2 = joined.filter(demand)
+        self.assertIs(res1, res2)
+
+        # the same subplan reached through a different rule is shared too
+        n_operators = dlog.live_operators()
+        other = dlog.Join(dlog.NotSimple(foo), dlog.NotSimple(bar), 1)
+        self.assertIs(other.filter(demand), res1)
+        self.assertEqual(dlog.live_operators(), n_operators)
+
+        dlog.sync(); self.assertEqual(res1.to_set(), { (2, 3, 5) })
+        bar.add((1, 7))
+        dlog.sync(); self.assertEqual(res1.to_set(), { (2, 3, 5), (1, 2, 7) })
+
+    def test_close_shared(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add((1, 2))
+        proj = dlog.masked_projection([ ((1, 1), foo) ], (1, 0))[0][1]
+        proj.close()
+
+        # a closed node is not handed out again
+        proj2 = dlog.masked_projection([ ((1, 1), foo) ], (1, 0))[0][1]
+        self.assertIsNot(proj2, proj)
+        foo.add((3, 4))
+        dlog.sync(); self.assertEqual(proj2.to_set(), { (2, 1), (4, 3) })
+
+    def test_close_shared_holders(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add((1, 2))
+        rel = dlog.NotSimple(foo)
+        q = dlog.single((1, None))
+        res1 = rel.filter([ ((1, 0), q) ])
+        res2 = rel.filter([ ((1, 0), q) ])
+        self.assertIs(res1, res2)
+
+        # the other holder keeps getting updates
+        res1.close()
+        foo.add((1, 5))
+        dlog.sync(); self.assertEqual(res2.to_set(), { (1, 2), (1, 5) })
+
+        res2.close()
+        foo.add((1, 6))
+        dlog.sync(); self.assertEqual(res2.to_set(), set())
+
+    def test_magic_sets(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3), (3, 4) ])
+        joined = dlog.Join(dlog.NotSimple(foo), dlog.Projection(dlog.NotSimple(foo), [1, 0]), 1)
+
+        q1 = dlog.DataRelation(arity=3)
+        q1.add((2, None, None))
+        res1 = joined.filter([ ((1, 0, 0), q1) ])
+        q2 = dlog.DataRelation(arity=3)
+        q2.add((3, None, None))
+        res2 = joined.filter([ ((1, 0, 0), q2) ])
+        dlog.sync()
+        self.assertEqual(res1.to_set(), { (2, 3, 1) })
+        self.assertEqual(res2.to_set(), { (3, 4, 2) })
+
+        # both queries are answered from one magic set
+        self.assertEqual(list(joined._magic_sets), [ ((1, 0, 0), dlog.default_scheduler) ])
+        demand = joined._magic_sets[(1, 0, 0), dlog.default_scheduler].demand
+        self.assertEqual(demand.to_set(), { (2, None, None), (3, None, None) })
+
+        q1.add((1, None, None))
+        q2.remove((3, None, None))
+        dlog.sync()
+        self.assertEqual(res1.to_set(), { (2, 3, 1) })
+        self.assertEqual(res2.to_set(), set())
+        foo.add((4, 1))
+        dlog.sync()
+        self.assertEqual(res1.to_set(), { (2, 3, 1), (1, 2, 4) })
+
+    def test_magic_sets_gc(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3) ])
+        rel = dlog.NotSimple(foo)
+
+        q = dlog.DataRelation(arity=2)
+        q.add((1, None))
+        res = rel.filter([ ((1, 0), q) ])
+        dlog.sync(); self.assertEqual(res.to_set(), { (1, 2) })
+
+        demand = rel._magic_sets[(1, 0), dlog.default_scheduler].demand
+        self.assertEqual(demand.to_set(), { (1, None) })
+        del res
+        gc.collect()
+        # the graph is only changed on the next sync()
+        self.assertEqual(len(demand.rels), 1)
+        dlog.sync()
+        self.assertEqual(demand.rels, [])
+        self.assertEqual(demand.to_set(), set())
+
+    def test_magic_sets_routing(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3) ])
+        rel = dlog.NotSimple(foo)
+
+        queries = [ dlog.DataRelation(arity=2) for k in range(3) ]
+        answers = []
+        calls = []
+        def counted(k, routed):
+            def f(added, removed):
+                calls.append(k)
+                routed(added, removed)
+            return f
+
+        for k, q in enumerate(queries):
+            q.add((k, None))
+            (mask, answered), = rel.masked_filter([ ((1, 0), q) ])
+            answered._routed = counted(k, answered._routed)
+            answers.append(answered)
+        dlog.sync()
+        self.assertEqual([ a.to_set() for a in answers ], [ set(), { (1, 2) }, { (2, 3) } ])
+        del calls[:]
+
+        # new answers only reach the queries they match
+        foo.add_many([ (1, 5), (7, 8) ])
+        dlog.sync()
+        self.assertEqual([ a.to_set() for a in answers ], [ set(), { (1, 2), (1, 5) }, { (2, 3) } ])
+        self.assertEqual(calls, [1])
+
+        queries[1].remove((1, None))
+        queries[2].add((1, None))
+        foo.remove((1, 2))
+        dlog.sync()
+        self.assertEqual([ a.to_set() for a in answers ], [ set(), set(), { (2, 3), (1, 5) } ])
+        self.assertEqual(calls, [1, 2])
+
+    def test_magic_sets_graphs(self):
+        # one relation answering demand from two graphs
+        func = dlog.ExternalFunction(func=(lambda x: x + 1), f_arity=1)
+        res1 = func.filter([ ((1, 0), dlog.single((1, None))) ])
+        graph = dlog.Scheduler()
+        res2 = func.filter([ ((1, 0), dlog.single((5, None), scheduler=graph)) ])
+        dlog.sync(); self.assertEqual(res1.to_set(), { (1, 2) })
+        graph.sync(); self.assertEqual(res2.to_set(), { (5, 6) })
+
+    def test_multi_join(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3), (3, 1), (1, 3) ])
+
+        triangles = dlog.MultiJoin([
+            (dlog.NotSimple(foo), (0, 1)), (dlog.NotSimple(foo), (1, 2)), (dlog.NotSimple(foo), (2, 0)),
+        ], 3)
+        res = triangles.filter([ ((1, 0, 0), dlog.single((1, None, None))) ])
+        dlog.sync(); self.assertEqual(res.to_set(), { (1, 2, 3) })
+
+        foo.add((2, 1))
+        foo.add((3, 2))
+        dlog.sync(); self.assertEqual(res.to_set(), { (1, 2, 3), (1, 3, 2) })
+
+    def test_multi_join_bound_atom(self):
+        foo = dlog.DataRelation(arity=2)
+        foo.add_many([ (1, 2), (2, 3), (3, 1), (2, 4) ])
+
+        # the function needs its argument bound by the other atoms
+        query = dlog.MultiJoin([
+            (dlog.NotSimple(foo), (0, 1)), (dlog.NotSimple(foo), (1, 2)), (dlog.NotSimple(foo), (2, 0)),
+            (dlog.ExternalFunction(func=(lambda x: x * 10), f_arity=1), (1, 3)),
+        ], 4)
+        res = query.filter([ ((1, 0, 0, 0), dlog.single((1, None, None, None))) ])
+        dlog.sync(); self.assertEqual(res.to_set(), { (1, 2, 3, 20) })
+
+        foo.add_many([ (1, 4), (4, 2), (2, 1) ])
+        dlog.sync(); self.assertEqual(res.to_set(), { (1, 2, 3, 20), (1, 4, 2, 40) })
+
+        # the atoms holding the bound variable only get its value as demand
+        atom = query.atoms[0][0]
+        self.assertEqual(atom._magic_sets[(1, 0), dlog.default_scheduler].demand.to_set(), { (1, 1) })
+
+        # an atom nothing binds the arguments of
+        unbound = dlog.MultiJoin([
+            (dlog.NotSimple(foo), (0, 1)), (dlog.ExternalFunction(func=(lambda x: x), f_arity=1), (2, 3)),
+        ], 4)
+        with self.assertRaises(Exception):
+            unbound.filter([ ((1, 0, 0, 0), dlog.single((1, None, None, None))) ])
+
     def test_external_function(self):
         foo = dlog.DataRelation(arity=2)
         foo.add((1, 10, None))
@@ -161,5 +792,84 @@ class OnDemandTests(unittest.TestCase):
         res_f = res.filter([ ((1,1,1), foo) ])
         dlog.sync(); self.assertEqual(res_f.to_set(), { (1, 10, 11), (2, 20, 22) })
 
+    def test_external_function_vectorized(self):
+        calls = []
+        def add(xs, ys):
+            calls.append(len(xs))
+            return [ x + y for x, y in zip(xs, ys) ]
+
+        res = dlog.ExternalFunction(func=add, f_arity=2, vectorized=True)
+        foo = dlog.DataRelation(arity=3)
+        foo.add_many([ (i, 10 * i, None) for i in range(100) ])
+        res_f = res.filter([ ((1,1,0), foo) ])
+        dlog.sync(); self.assertEqual(res_f.to_set(), { (i, 10 * i, 11 * i) for i in range(100) })
+
+        foo.add_many([ (1000, 1, None), (2000, 2, None) ])
+        dlog.sync(); self.assertEqual(len(res_f.to_set()), 102)
+        self.assertEqual(calls, [100, 2])
+
+    def test_external_function_policies(self):
+        async def add_async(a, b):
+            await asyncio.sleep(0)
+            return a + b
+
+        thread_names = set()
+        def add_threads(a, b):
+            thread_names.add(threading.current_thread().name)
+            return a + b
+
+        functions = [
+            dlog.ExternalFunction(func=add_threads, f_arity=2, policy='threads', max_workers=4),
+            dlog.ExternalFunction(func=operator.add, f_arity=2, policy='processes', max_workers=2),
+            dlog.ExternalFunction(func=add_async, f_arity=2, policy='asyncio'),
+            dlog.ExternalFunction(func=(lambda xs, ys: [ x + y for x, y in zip(xs, ys) ]), f_arity=2,
+                                  vectorized=True, policy='threads', max_workers=3),
+        ]
+
+        foo = dlog.DataRelation(arity=3)
+        foo.add_many([ (i, 10 * i, None) for i in range(50) ])
+        results = [ res.filter([ ((1,1,0), foo) ]) for res in functions ]
+        dlog.sync()
+        for res_f in results:
+            self.assertEqual(res_f.to_set(), { (i, 10 * i, 11 * i) for i in range(50) })
+        self.assertNotIn(threading.current_thread().name, thread_names)
+
+        with self.assertRaises(ValueError):
+            dlog.ExternalFunction(func=operator.add, f_arity=2, policy='gpu')
+
+    def test_external_function_cache(self):
+        calls = []
+        res = dlog.ExternalFunction(func=(lambda a, b: calls.append((a, b)) or a+b), f_arity=2,
+                                    cache=dlog.FunctionCache())
+
+        foo = dlog.DataRelation(arity=3)
+        foo.add_many([ (1, 10, None), (2, 20, None) ])
+        res_f = res.filter([ ((1,1,0), foo) ])
+
+        bar = dlog.DataRelation(arity=3)
+        bar.add_many([ (1, 10, 11), (3, 30, 33) ])
+        res_g = res.filter([ ((1,1,1), bar) ])
+
+        dlog.sync(); self.assertEqual(res_f.to_set(), { (1, 10, 11), (2, 20, 22) })
+        self.assertEqual(res_g.to_set(), { (1, 10, 11), (3, 30, 33) })
+
+        foo.remove((2, 20, None))
+        dlog.sync()
+        foo.add((2, 20, None))
+        dlog.sync(); self.assertEqual(res_f.to_set(), { (1, 10, 11), (2, 20, 22) })
+
+        self.assertEqual(sorted(calls), [ (1, 10), (2, 20), (3, 30) ])
+        self.assertEqual((res.cache.hits, res.cache.misses), (2, 3))
+
+        # functions sharing a cache don't see each other's results
+        cache = dlog.FunctionCache()
+        inc = dlog.ExternalFunction(func=(lambda x: x + 1), f_arity=1, cache=cache)
+        times = dlog.ExternalFunction(func=(lambda x: x * 100), f_arity=1, cache=cache)
+        arg = dlog.single((1, None))
+        inc_f = inc.filter([ ((1, 0), arg) ])
+        times_f = times.filter([ ((1, 0), arg) ])
+        dlog.sync(); self.assertEqual(inc_f.to_set(), { (1, 2) })
+        self.assertEqual(times_f.to_set(), { (1, 100) })
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,6 @@
+import collections
+
+_MISSING = object()
 
 class Lazy:
     def __init__(self, f):
@@ -24,10 +27,12 @@ class Combinator:
         self.f = f
 
     def _run(self, x):
-        if (self, x) not in x.memo:
-            x.memo[self, x] = self.f(x)
+        column = x.memo.column(x.offset)
+        res = column.get(self, _MISSING)
+        if res is _MISSING:
+            res = column[self] = self.f(x)
 
-        return x.memo[self, x]
+        return res
 
     def map(self, g):
         return _map(self, g)
@@ -41,12 +46,47 @@ class Combinator:
 def combinator(f):
     return Combinator(f)
 
+class _Rope:
+    '''
+    Concatenation of results (tuples or other ropes). Combinators build
+    ropes instead of copying tuples and they are flattened only when the
+    result is passed to a map() function or returned from run().
+    '''
+
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        # nonempty parts only, so that a rope is never empty
+        self.parts = parts
+
+def _flatten(r):
+    if type(r) is tuple:
+        return r
+
+    result = []
+    stack = [r]
+    while stack:
+        r = stack.pop()
+        if type(r) is _Rope:
+            stack.extend(reversed(r.parts))
+        else:
+            result += r
+
+    return tuple(result)
+
+def _join(r_a, r_b):
+    if not r_a: return r_b
+    if not r_b: return r_a
+    if type(r_a) is tuple and type(r_b) is tuple and len(r_a) + len(r_b) <= 16:
+        return r_a + r_b
+    return _Rope((r_a, r_b))
+
 def _map(a, g):
     def f(text):
         res = a._run(text)
         if res:
             r, text1 = res
-            return g(r), text1
+            return g(_flatten(r)), text1
 
     return Combinator(f)
 
@@ -58,7 +98,7 @@ def _concat(a, b):
         res = b._run(text1)
         if res is None: return None
         r_b, text2 = res
-        return (r_a + r_b, text2)
+        return (_join(r_a, r_b), text2)
 
     return Combinator(f)
 
@@ -89,7 +129,9 @@ inf = float('inf')
 
 def many(op, n_min=0, n_max=inf):
     def f(text):
-        result = []
+        # tuples are collected in `flat`, ropes are kept as they are
+        parts = []
+        flat = []
         count = 0
 
         while True:
@@ -98,13 +140,35 @@ def many(op, n_min=0, n_max=inf):
             res = op._run(text)
             if res is None: break
             value, text = res
-            result += value
+            if type(value) is tuple:
+                flat += value
+            else:
+                if flat:
+                    parts.append(tuple(flat))
+                    flat = []
+                parts.append(value)
             count += 1
 
         if count < n_min or count > n_max:
             return None
 
-        return tuple(result), text
+        if not parts:
+            return tuple(flat), text
+
+        if flat: parts.append(tuple(flat))
+        return (parts[0] if len(parts) == 1 else _Rope(parts)), text
+
+    return Combinator(f)
+
+def cut():
+    '''
+    Promises that the parser won't backtrack behind the current position,
+    so the memo entries before it can be dropped. If it does backtrack
+    anyway, the result is the same, only the memo has to be rebuilt.
+    '''
+    def f(text):
+        text.memo.discard_before(text.offset)
+        return ((), text)
 
     return Combinator(f)
 
@@ -115,13 +179,91 @@ def joined_with(sep, val):
     return many(val + sep) + val
 
 class ForwardDecl(Combinator):
-    def __init__(self):
+    '''
+    Placeholder for a recursive rule, `value` is set after the rule is
+    defined. A rule that calls itself at the same position (e.g. `expr =
+    expr + char('+') + term | term`) needs `left_recursive=True`: it is
+    then parsed by growing a seed - first with the recursive call failing,
+    then reparsed with the previous result for the call for as long as the
+    match gets longer.
+    '''
+
+    def __init__(self, left_recursive=False):
         self.value = None
+        self.left_recursive = left_recursive
 
     def _run(self, x):
-        return self.value._run(x)
+        if not self.left_recursive:
+            return self.value._run(x)
+
+        memo = x.memo
+        column = memo.column(x.offset)
+        res = column.get(self, _MISSING)
+        if res is not _MISSING:
+            return res
+
+        res = column[self] = None
+        memo.pinned[x.offset] += 1
+        try:
+            while True:
+                new = self.value._run(x)
+                if new is None or (res is not None and new[1].offset <= res[1].offset):
+                    break
+
+                res = column[self] = new
+                # other results at this position may have used the old seed
+                for key in [ key for key in column if not _is_left_recursive(key) ]:
+                    del column[key]
+        finally:
+            memo.pinned[x.offset] -= 1
+            if not memo.pinned[x.offset]:
+                del memo.pinned[x.offset]
+
+        return res
+
+def _is_left_recursive(c):
+    return isinstance(c, ForwardDecl) and c.left_recursive
+
+class Memo:
+    '''
+    Packrat memo table: offset -> {combinator: result}. With `window` set,
+    only about 2 * window positions behind the furthest one are kept.
+    '''
+
+    def __init__(self, window=None):
+        self.columns = {}
+        self.window = window
+        # everything before this offset was discarded
+        self.low = 0
+        # offset -> number of left recursive rules growing there
+        self.pinned = collections.Counter()
+
+    def column(self, offset):
+        column = self.columns.get(offset)
+        if column is None:
+            column = self.columns[offset] = {}
+            # discard in batches, so that the scan is amortized
+            if self.window is not None and offset - self.low > 2 * self.window:
+                self.discard_before(offset - self.window)
+
+        return column
+
+    def discard_before(self, offset):
+        if offset <= self.low:
+            return
+
+        self.low = offset
+        for o in [ o for o in self.columns if o < offset and o not in self.pinned ]:
+            del self.columns[o]
 
 class Input:
+    '''
+    Position in `text`. Inputs are cheap cursors - all of them share the
+    text and the memo table of one run().
+    '''
+
+    __slots__ = ('memo', 'text', 'offset')
+
     def __init__(self, memo, text, offset):
         self.memo = memo
         self.text = text
@@ -142,23 +284,23 @@ class Input:
         return self.offset < len(self.text)
 
     def __hash__(self):
-        return hash((self.text, self.offset))
+        return hash(self.offset)
 
     def __eq__(self, o):
-        if not isinstane(o, Input):
+        if not isinstance(o, Input):
             return False
 
-        return (self.text, self.offset) == (o.text, o.offset)
+        return self.offset == o.offset and (self.text is o.text or self.text == o.text)
 
     def __repr__(self):
         return '<Input %d>' % self.offset
 
-def run(cat, text):
+def run(cat, text, window=None):
     if isinstance(text, list): text = tuple(text)
-    memo = {}
+    memo = Memo(window)
     result = cat._run(Input(memo, text, 0))
     if result is not None:
-        return result[0]
+        return _flatten(result[0])
 
 if __name__ == '__main__':
     def char(c):
@@ -0,0 +1,23 @@
+# Timing check for parsercombinators, not part of the unit tests (wall
+# clock ratios are too noisy for a loaded CI machine). Run directly:
+#   python parsercombinators_bench.py
+import sys, time
+import parsercombinators as pc
+from parsercombinators_tests import char
+
+def parse_time(n):
+    items = pc.ForwardDecl(left_recursive=True)
+    items.value = items + char(',') + char('x') | char('x')
+    tokens = [ 'x', ',' ] * n + [ 'x' ]
+    start = time.perf_counter()
+    result = pc.run(pc.many(pc.joined_with(char(';'), items)), tokens)
+    assert len(result) == len(tokens)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    # 10^4 and 10^5 tokens - quadratic accumulation would take ~100x longer
+    small = min( parse_time(5000) for i in range(3) )
+    large = min( parse_time(50000) for i in range(3) )
+    print('10^4 tokens: %.3fs, 10^5 tokens: %.3fs, ratio %.1f' % (small, large, large / small))
+    if large > small * 30:
+        sys.exit('parse time grows faster than linearly')
@@ -0,0 +1,89 @@
+import unittest
+import parsercombinators as pc
+
+def char(c):
+    def f(text):
+        if text and text[0] == c: return (c,), text[1:]
+    return pc.combinator(f)
+
+digit = pc.combinator(lambda text: ((int(text[0]),), text[1:]) if text and text[0].isdigit() else None)
+
+def difference():
+    # left associative: 9-3-2 == 4
+    expr = pc.ForwardDecl(left_recursive=True)
+    expr.value = (expr + char('-') + digit).map(lambda r: (r[0] - r[2],)) | digit
+    return expr
+
+class ParserTests(unittest.TestCase):
+    def test_optional(self):
+        self.assertEqual(pc.run(pc.optional(char('f')), ''), ())
+        self.assertEqual(pc.run(pc.optional(char('f')), 'f'), ('f',))
+        self.assertEqual(pc.run(pc.optional(char('f')), 'ff'), ('f',))
+
+    def test_either(self):
+        cat = (char('a') + char('b')) | (char('a') + char('c'))
+        self.assertEqual(pc.run(cat, 'ac'), ('a', 'c'))
+        self.assertEqual(pc.run(cat, 'ad'), None)
+
+    def test_input(self):
+        text = 'abc'
+        a = pc.Input({}, text, 1)
+        self.assertEqual(a, pc.Input({}, text, 0)[1:])
+        self.assertNotEqual(a, pc.Input({}, text, 2))
+        self.assertNotEqual(a, 1)
+        self.assertEqual(a[0], 'b')
+        self.assertEqual(a[0:2], 'bc')
+
+    def test_memo(self):
+        calls = []
+        def f(text):
+            calls.append(text.offset)
+            if text and text[0] == 'a': return ('a',), text[1:]
+        a = pc.combinator(f)
+
+        # every alternative parses `a` again at the same offsets
+        cat = (pc.many(a) + char('b')) | (pc.many(a) + char('c')) | (pc.many(a) + char('d'))
+        self.assertEqual(pc.run(cat, 'a' * 100 + 'd'), ('a',) * 100 + ('d',))
+        self.assertEqual(sorted(calls), list(range(101)))
+
+    def test_left_recursion(self):
+        expr = difference()
+        self.assertEqual(pc.run(expr, '9'), (9,))
+        self.assertEqual(pc.run(expr, '9-3-2'), (4,))
+        self.assertEqual(pc.run(expr + char(';'), '9-3-2;'), (4, ';'))
+        self.assertEqual(pc.run(expr, '-'), None)
+
+        # nested left recursive rules starting at the same position
+        product = pc.ForwardDecl(left_recursive=True)
+        product.value = (product + char('*') + digit).map(lambda r: (r[0] * r[2],)) | digit
+        total = pc.ForwardDecl(left_recursive=True)
+        total.value = (total + char('+') + product).map(lambda r: (r[0] + r[2],)) | product
+        self.assertEqual(pc.run(total, '2*3+4*5*2+1'), (47,))
+
+    def test_long_chain(self):
+        # grows iteratively, without a Python frame per operator
+        self.assertEqual(pc.run(difference(), '1-' * 20000 + '1'), (-19999,))
+
+    def test_window(self):
+        text = '1-' * 5000 + '1'
+        memo = pc.Memo(window=50)
+        result = difference()._run(pc.Input(memo, text, 0))
+        self.assertEqual(result[0], (-4999,))
+        self.assertLessEqual(len(memo.columns), 101)
+
+    def test_cut(self):
+        stmt = pc.joined_with(char('-'), digit) + char(';') + pc.cut()
+        memo = pc.Memo()
+        result = pc.many(stmt).wrap()._run(pc.Input(memo, '1-2;3;4-5-6;', 0))
+        self.assertEqual(result[0], ((1, '-', 2, ';', 3, ';', 4, '-', 5, '-', 6, ';'),))
+        self.assertTrue(all( offset >= 12 for offset in memo.columns ))
+
+    def test_long_sequence(self):
+        # 10^5 tokens, see parsercombinators_bench.py for the timing
+        items = pc.ForwardDecl(left_recursive=True)
+        items.value = items + char(',') + char('x') | char('x')
+        tokens = [ 'x', ',' ] * 50000 + [ 'x' ]
+        self.assertEqual(pc.run(pc.many(pc.joined_with(char(';'), items)), tokens), tuple(tokens))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,76 +3,7 @@ from typing import NamedTuple, Any, Tuple, Union, List
 import dlog
 import roboot_parser as parser
 import roboot_python_ast
-
-@dataclass(frozen=True, eq=False)
-class IrNode:
-    pass
-
-@dataclass(frozen=True, eq=False)
-class IrRelation(IrNode):
-    rel: Any
-    axis_names: List[str]
-
-@dataclass(frozen=True, eq=False)
-class IrIntersect(IrNode):
-    a: Any
-    b: Any
-
-    @staticmethod
-    def make(lst): # O(n^2)!
-        if len(lst) == 1: return lst
-        return IrIntersect(lst[0], IrIntersect.make(lst[1:]))
-
-@dataclass(frozen=True, eq=False)
-class IrUnion(IrNode):
-    a: Any
-    b: Any
-
-@dataclass(frozen=True, eq=False)
-class IrIntroduce(IrNode):
-    a: Any
-    name: str
-
-def ir_get_axis_names(ir_node, result):
-    if isinstance(ir_node, IrIntersect):
-        ir_get_axis_names(ir_node.a, result)
-        ir_get_axis_names(ir_node.b, result)
-        return (
-            sorted(set(result[ir_node.a]) & set(result[ir_node.b])) +
-            sorted(set(result[ir_node.a]) - set(result[ir_node.b])) +
-            sorted(set(result[ir_node.b]) - set(result[ir_node.a])))
-    elif isinstance(ir_node, IrRelation):
-        result[ir_node] = ir_node.axis_names
-    else:
-        assert False
-
-def compile_ir(ir_node, axis_names):
-    if isinstance(ir_node, IrIntersect):
-        a_names = axis_names[ir_node.a]
-        b_names = axis_names[ir_node.b]
-        a_arity = len(a_names)
-        b_arity = len(a_names)
-        join_k = len(intersection_list)
-        intersection_set = set(a_names) & set(b_names)
-        intersection_list = a_names[:join_k]
-        assert set(intersection_list) == intersection_set
-
-        a_proj = dlog.Projection(ir_node.a, [ a_names.index(name) for name in intersection_list[:a_arity] ])
-        b_proj = dlog.Projection(ir_node.b, [ b_names.index(name) for name in intersection_list[:join_k] + intersection_list[a_arity:] ])
-        return dlog.Join(a_proj, b_proj, join_k)
-    elif isinstance(ir_node, IrRelation):
-        return ir_node.rel
-    elif isinstance(ir_node, IrUnion):
-        left = ir_node.left
-        right = ir_node.right
-        if set(axis_names[left]) != set(axis_names[right]): # ???
-            raise Exception('inconsistent variables %r != %r' % (set(axis_names[left]), set(axis_names[right])))
-
-        return dlog.Union(
-            left,
-            Projection(right, [ axis_names[right].index(name) for name in axis_names[left] ]))
-    else:
-        assert False
+from roboot_ir import *
 
 class GenSym: pass
 
@@ -93,6 +24,7 @@ class Compiler:
     def __init__(self, module):
         self.module = module
         self.top_arg_names = None
+        self.planner = Planner()
 
     def compile_relation_expr_aux(self, node, arg_names, additional_relations):
         if isinstance(node, parser.Ident):
@@ -169,7 +101,7 @@ class Compiler:
     def compile_stmt(self, stmt):
         if isinstance(stmt, ERelation):
             expected_args = stmt.head.args
-            ir_relation = self.compile_relation(stmt.body)
+            ir_relation = self.planner.plan(self.compile_relation(stmt.body))
 
             arg_names = {}
             ir_get_axis_names(ir_relation, arg_names)
@@ -0,0 +1,274 @@
+from dataclasses import dataclass
+from typing import Any, List
+import dlog
+
+@dataclass(frozen=True, eq=False)
+class IrNode:
+    pass
+
+@dataclass(frozen=True, eq=False)
+class IrRelation(IrNode):
+    rel: Any
+    axis_names: List[str]
+
+@dataclass(frozen=True, eq=False)
+class IrIntersect(IrNode):
+    a: Any
+    b: Any
+
+    @staticmethod
+    def make(lst):
+        if len(lst) == 1: return lst[0]
+        if len(lst) == 2: return IrIntersect(lst[0], lst[1])
+        return IrMultiIntersect(list(lst))
+
+@dataclass(frozen=True, eq=False)
+class IrMultiIntersect(IrNode):
+    # joined all at once (dlog.MultiJoin) instead of as a chain of binary joins
+    members: List[Any]
+
+def ir_flatten_intersections(ir_node):
+    if isinstance(ir_node, (IrIntersect, IrMultiIntersect)):
+        members = [ir_node.a, ir_node.b] if isinstance(ir_node, IrIntersect) else ir_node.members
+        flat = []
+        for member in map(ir_flatten_intersections, members):
+            if isinstance(member, IrIntersect):
+                flat += [member.a, member.b]
+            elif isinstance(member, IrMultiIntersect):
+                flat += member.members
+            else:
+                flat.append(member)
+        return IrIntersect.make(flat)
+    elif isinstance(ir_node, IrUnion):
+        return IrUnion(ir_flatten_intersections(ir_node.a), ir_flatten_intersections(ir_node.b))
+    elif isinstance(ir_node, IrIntroduce):
+        return IrIntroduce(ir_flatten_intersections(ir_node.a), ir_node.name)
+    else:
+        return ir_node
+
+@dataclass(frozen=True, eq=False)
+class IrUnion(IrNode):
+    a: Any
+    b: Any
+
+@dataclass(frozen=True, eq=False)
+class IrIntroduce(IrNode):
+    a: Any
+    name: str
+
+def ir_get_axis_names(ir_node, result):
+    if isinstance(ir_node, IrIntersect):
+        ir_get_axis_names(ir_node.a, result)
+        ir_get_axis_names(ir_node.b, result)
+        # join keys (the shared variables) first, as dlog.Join expects
+        result[ir_node] = (
+            sorted(set(result[ir_node.a]) & set(result[ir_node.b])) +
+            sorted(set(result[ir_node.a]) - set(result[ir_node.b])) +
+            sorted(set(result[ir_node.b]) - set(result[ir_node.a])))
+        return result[ir_node]
+    elif isinstance(ir_node, IrMultiIntersect):
+        for member in ir_node.members:
+            ir_get_axis_names(member, result)
+        # variables shared by many members first, so they are bound early
+        order = []
+        for member in ir_node.members:
+            order += [ name for name in result[member] if name not in order ]
+        counts = { name: sum( name in result[member] for member in ir_node.members ) for name in order }
+        result[ir_node] = sorted(order, key=lambda name: -counts[name])
+        return result[ir_node]
+    elif isinstance(ir_node, IrRelation):
+        result[ir_node] = ir_node.axis_names
+    else:
+        assert False
+
+def compile_ir(ir_node, axis_names):
+    if isinstance(ir_node, IrIntersect):
+        a_names = axis_names[ir_node.a]
+        b_names = axis_names[ir_node.b]
+        names = axis_names[ir_node]
+        a_arity = len(a_names)
+        join_k = len(set(a_names) & set(b_names))
+
+        a_proj = dlog.Projection(compile_ir(ir_node.a, axis_names), [ a_names.index(name) for name in names[:a_arity] ])
+        b_proj = dlog.Projection(compile_ir(ir_node.b, axis_names), [ b_names.index(name) for name in names[:join_k] + names[a_arity:] ])
+        return dlog.Join(a_proj, b_proj, join_k)
+    elif isinstance(ir_node, IrMultiIntersect):
+        names = axis_names[ir_node]
+        return dlog.MultiJoin([
+            (compile_ir(member, axis_names), [ names.index(name) for name in axis_names[member] ])
+            for member in ir_node.members
+        ], len(names))
+    elif isinstance(ir_node, IrRelation):
+        return ir_node.rel
+    elif isinstance(ir_node, IrUnion):
+        left = ir_node.left
+        right = ir_node.right
+        if set(axis_names[left]) != set(axis_names[right]): # ???
+            raise Exception('inconsistent variables %r != %r' % (set(axis_names[left]), set(axis_names[right])))
+
+        return dlog.Union(
+            left,
+            Projection(right, [ axis_names[right].index(name) for name in axis_names[left] ]))
+    else:
+        assert False
+
+@dataclass
+class Estimate:
+    count: float
+    # axis name -> estimated number of distinct values
+    distinct: dict
+
+def _join_estimate(a, b):
+    # textbook estimate: |A join B| = |A| |B| / max(V(A, x), V(B, x)) for each shared x
+    count = a.count * b.count
+    for name in a.distinct.keys() & b.distinct.keys():
+        count /= max(a.distinct[name], b.distinct[name], 1)
+
+    distinct = {}
+    for name in a.distinct.keys() | b.distinct.keys():
+        distinct[name] = min(a.distinct.get(name, count), b.distinct.get(name, count), count)
+    return Estimate(count, distinct)
+
+def _is_acyclic(members):
+    # GYO reduction on the variable sets of the members
+    edges = [ set(names) for names in members ]
+    changed = True
+    while changed and len(edges) > 1:
+        changed = False
+        for edge in edges:
+            lonely = { name for name in edge if sum( name in other for other in edges ) == 1 }
+            if lonely:
+                edge -= lonely
+                changed = True
+        for i, edge in enumerate(edges):
+            if any( j != i and edge <= other for j, other in enumerate(edges) ):
+                del edges[i]
+                changed = True
+                break
+    return len(edges) <= 1
+
+class Planner:
+    '''
+    Chooses the join order of intersections using statistics of the live
+    relations (as seen when the rule is compiled). Acyclic bodies become a
+    left-deep IrIntersect tree; cyclic ones are kept as a single
+    IrMultiIntersect with members in the chosen order.
+    '''
+
+    # assumed size of relations that don't provide statistics
+    default_count = 1000
+
+    def __init__(self):
+        self.estimates = {}
+
+    def relation_estimate(self, ir_node):
+        stats = ir_node.rel.statistics()
+        if stats is None:
+            stats = dlog.RelationStats(self.default_count, (self.default_count,) * len(ir_node.axis_names))
+
+        distinct = {}
+        for name, n in zip(ir_node.axis_names, stats.distinct):
+            distinct[name] = min(distinct.get(name, n), n)
+        return Estimate(stats.count, distinct)
+
+    def plan(self, ir_node):
+        ir_node = ir_flatten_intersections(ir_node)
+
+        if isinstance(ir_node, (IrIntersect, IrMultiIntersect)):
+            members = [ir_node.a, ir_node.b] if isinstance(ir_node, IrIntersect) else ir_node.members
+            result = self.plan_intersection([ self.plan(member) for member in members ])
+        elif isinstance(ir_node, IrUnion):
+            result = IrUnion(self.plan(ir_node.a), self.plan(ir_node.b))
+            a = self.estimates[result.a]
+            b = self.estimates[result.b]
+            self.estimates[result] = Estimate(a.count + b.count, {
+                name: a.distinct.get(name, 0) + b.distinct.get(name, 0)
+                for name in a.distinct.keys() | b.distinct.keys() })
+        elif isinstance(ir_node, IrIntroduce):
+            result = IrIntroduce(self.plan(ir_node.a), ir_node.name)
+            self.estimates[result] = self.estimates[result.a]
+        elif isinstance(ir_node, IrRelation):
+            result = ir_node
+            self.estimates[result] = self.relation_estimate(ir_node)
+        else:
+            assert False
+
+        return result
+
+    def plan_intersection(self, members):
+        # greedy: start from the smallest member, then repeatedly add the
+        # member giving the smallest intermediate result, preferring members
+        # that share a variable with what is already joined (no cross products)
+        remaining = list(members)
+        first = min(remaining, key=lambda m: self.estimates[m].count)
+        remaining.remove(first)
+        order = [first]
+        current = self.estimates[first]
+        prefix = first
+
+        while remaining:
+            def cost(m):
+                connected = bool(current.distinct.keys() & self.estimates[m].distinct.keys())
+                return (not connected, _join_estimate(current, self.estimates[m]).count)
+
+            best = min(remaining, key=cost)
+            remaining.remove(best)
+            order.append(best)
+            current = _join_estimate(current, self.estimates[best])
+            prefix = IrIntersect(prefix, best)
+            self.estimates[prefix] = current
+
+        if len(order) > 2 and not _is_acyclic([ self.estimates[m].distinct.keys() for m in order ]):
+            prefix = IrMultiIntersect(order)
+            self.estimates[prefix] = current
+        return prefix
+
+    def explain(self, ir_node, actual=False, scheduler=None):
+        '''
+        Returns the plan as text, one node per line, with the estimated
+        cardinality of each node. With actual=True every subplan is also
+        compiled and evaluated on `scheduler` (the graph of the relations,
+        default_scheduler if not given) to show the real cardinality.
+        '''
+        axis_names = {}
+        ir_get_axis_names(ir_node, axis_names)
+
+        lines = []
+        def visit(node, depth):
+            if isinstance(node, IrIntersect):
+                members = [node.a, node.b]
+                label = 'intersect on %s' % sorted(set(axis_names[node.a]) & set(axis_names[node.b]))
+            elif isinstance(node, IrMultiIntersect):
+                members = node.members
+                label = 'multi-intersect over %s' % axis_names[node]
+            elif isinstance(node, IrUnion):
+                members = [node.a, node.b]
+                label = 'union'
+            elif isinstance(node, IrIntroduce):
+                members = [node.a]
+                label = 'introduce %s' % node.name
+            else:
+                members = []
+                label = 'relation %r(%s)' % (node.rel, ', '.join(map(str, node.axis_names)))
+
+            line = '%s%s  est=%d' % ('  ' * depth, label, round(self.estimates[node].count))
+            if actual:
+                line += '  actual=%s' % ir_cardinality(node, axis_names, scheduler)
+            lines.append(line)
+
+            for member in members:
+                visit(member, depth + 1)
+
+        visit(ir_node, 0)
+        return '\n'.join(lines)
+
+def ir_cardinality(ir_node, axis_names, scheduler=None):
+    arity = len(axis_names[ir_node])
+    rel = compile_ir(ir_node, axis_names)
+    try:
+        simple = rel.filter([ ((0,) * arity, dlog.single((None,) * arity, scheduler=scheduler)) ])
+    except Exception:
+        # can't be enumerated without bound arguments (e.g. an external function)
+        return '?'
+    simple._scheduler.sync()
+    return len(simple.to_set())
@@ -0,0 +1,71 @@
+import unittest
+import dlog
+from roboot_ir import *
+
+def relation(tuples, *axis_names, scheduler=None):
+    rel = dlog.DataRelation(arity=len(axis_names), scheduler=scheduler)
+    rel.add_many(tuples)
+    return IrRelation(rel=dlog.NotSimple(rel), axis_names=list(axis_names))
+
+class PlannerTests(unittest.TestCase):
+    def test_order(self):
+        big = relation([ (i, i % 10) for i in range(100) ], 'y', 'z')
+        small = relation([ (1, 2), (2, 3) ], 'x', 'y')
+        medium = relation([ (i, i) for i in range(10) ], 'z', 'w')
+
+        planner = Planner()
+        plan = planner.plan(IrIntersect(IrIntersect(big, medium), small))
+        # the smallest relation first, then what shares a variable with it
+        self.assertIsInstance(plan, IrIntersect)
+        self.assertIs(plan.b, medium)
+        self.assertIs(plan.a.a, small)
+        self.assertIs(plan.a.b, big)
+        self.assertEqual(planner.estimates[plan.a].count, 2)
+
+        lines = planner.explain(plan, actual=True).split('\n')
+        self.assertEqual(lines[0], "intersect on ['z']  est=2  actual=2")
+        self.assertTrue(lines[1].startswith("  intersect on ['y']  est=2  actual=2"))
+
+    def test_cyclic(self):
+        edges = [ (1, 2), (2, 3), (3, 1) ]
+        triangle = [ relation(edges, 'x', 'y'), relation(edges, 'y', 'z'), relation(edges, 'z', 'x') ]
+        plan = Planner().plan(IrIntersect.make(triangle))
+        self.assertIsInstance(plan, IrMultiIntersect)
+        self.assertEqual(set(plan.members), set(triangle))
+
+        path = [ relation(edges, 'x', 'y'), relation(edges, 'y', 'z'), relation(edges, 'z', 'w') ]
+        plan = Planner().plan(IrIntersect.make(path))
+        self.assertIsInstance(plan, IrIntersect)
+
+    def test_explain(self):
+        edges = [ (1, 2), (2, 3), (3, 1), (1, 3) ]
+        planner = Planner()
+        plan = planner.plan(IrIntersect.make([
+            relation(edges, 'x', 'y'), relation(edges, 'y', 'z'), relation(edges, 'z', 'x') ]))
+
+        lines = planner.explain(plan, actual=True).split('\n')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("multi-intersect over"))
+        # (1, 2, 3) in its three rotations
+        self.assertTrue(lines[0].endswith('actual=3'))
+        for line in lines[1:]:
+            self.assertTrue(line.startswith('  relation'))
+            self.assertIn('est=4', line)
+            self.assertTrue(line.endswith('actual=4'))
+
+    def test_explain_other_graph(self):
+        graph = dlog.Scheduler()
+        planner = Planner()
+        plan = planner.plan(IrIntersect(
+            relation([ (1, 2), (2, 3) ], 'x', 'y', scheduler=graph), relation([ (2, 5) ], 'y', 'z', scheduler=graph)))
+
+        # a pending change of the default graph is not flushed by explain()
+        other = dlog.DataRelation(arity=1)
+        other.add((1,))
+        lines = planner.explain(plan, actual=True, scheduler=graph).split('\n')
+        self.assertTrue(lines[0].endswith('actual=1'))
+        self.assertEqual(other._added, { (1,) })
+        dlog.sync()
+
+if __name__ == '__main__':
+    unittest.main()